@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from functools import partial
 import os
-from typing import Callable, Dict, List, Optional, Tuple, Type
+from typing import Callable, Dict, FrozenSet, List, Optional, Tuple, Type
 import matplotlib.pyplot as plt
 import seaborn as sns
 
@@ -87,6 +87,10 @@ class NeuroEvolutionAgentSpecies(AgentSpecies):
         self.names_measures: List[str] = sum(
             [names for type_measure, names in config["metrics"]["measures"].items()], []
         )
+        # The names of the population-level measures, which are not masked per agent
+        self.names_measures_global: FrozenSet[str] = frozenset(
+            config["metrics"]["measures"]["global"]
+        )
 
     def reset(self, key_random: jnp.ndarray) -> StateSpeciesNE:
 
@@ -121,7 +125,13 @@ class NeuroEvolutionAgentSpecies(AgentSpecies):
 
     def init_hp(self) -> HyperParametersNE:
         """Get the initial hyperparameters of the agent from the config"""
-        return HyperParametersNE(**self.config["hp_initial"])
+        # The hyperparameters are given a fixed dtype, so that the state of the species keeps the same types across the steps of the compiled loop
+        return HyperParametersNE(
+            **{
+                name_hp: jnp.asarray(value, dtype=jnp.float32)
+                for name_hp, value in self.config["hp_initial"].items()
+            }
+        )
 
     def init_agent(
         self,
@@ -243,7 +253,7 @@ class NeuroEvolutionAgentSpecies(AgentSpecies):
 
         # Set the measures to NaN for the agents that are not existing
         for name_measure, measures in dict_measures_all.items():
-            if name_measure not in self.config["metrics"]["measures"]["global"]:
+            if name_measure not in self.names_measures_global:
                 dict_measures_all[name_measure] = jnp.where(
                     state.agents.do_exist,
                     measures,
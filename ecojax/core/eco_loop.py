@@ -1,5 +1,6 @@
 # Logging
 from collections import defaultdict
+from functools import partial
 import os
 import cProfile
 
@@ -18,7 +19,7 @@ from ecojax.loggers.wandb import LoggerWandB
 from tqdm import tqdm
 import datetime
 from time import time, sleep
-from typing import Any, Dict, List, Tuple, Type
+from typing import Any, Callable, Dict, List, Tuple, Type
 from pprint import pprint
 
 # ML libraries
@@ -33,7 +34,7 @@ from jax.lax import while_loop
 # Project imports
 from ecojax.environment import EcoEnvironment, env_name_to_EnvClass
 from ecojax.agents import AgentSpecies, agent_name_to_AgentSpeciesClass
-from ecojax.metrics.utils import get_dict_metrics_by_type
+from ecojax.metrics.utils import explode_appearance, get_dict_metrics_by_type
 from ecojax.models import model_name_to_ModelClass
 from ecojax.core.eco_info import EcoInformation
 from ecojax.time_measure import RuntimeMeter, get_runtime_metrics
@@ -41,6 +42,41 @@ from ecojax.types import ObservationAgent, StateEnv, StateGlobal, StateSpecies
 from ecojax.utils import check_jax_device, is_array, is_scalar, try_get_seed
 
 
+def run_chunk(
+    step: Callable[[StateGlobal], Tuple[StateGlobal, Any]],
+    global_state: StateGlobal,
+    n_steps: jnp.ndarray,
+    n_steps_per_chunk: int,
+    outputs_shape: Any,
+) -> Tuple[StateGlobal, Any]:
+    """Perform n_steps <= n_steps_per_chunk steps of the simulation in a single loop of n_steps_per_chunk iterations.
+    The iterations beyond n_steps, and the steps after the environment is done, leave the global state unchanged.
+
+    Args:
+        step (Callable[[StateGlobal], Tuple[StateGlobal, Any]]): the function performing one step, returning the new global state and the outputs of the step
+        global_state (StateGlobal): the global state before the chunk
+        n_steps (jnp.ndarray): the number of steps to perform
+        n_steps_per_chunk (int): the number of iterations of the loop
+        outputs_shape (Any): the shapes and dtypes of the outputs of a step, as given by jax.eval_shape
+
+    Returns:
+        global_state (StateGlobal): the global state after the n_steps steps
+        outputs (Any): the outputs of each iteration, stacked along a leading (n_steps_per_chunk,) axis, and zeroed for the skipped iterations
+    """
+
+    def skip(global_state: StateGlobal) -> Tuple[StateGlobal, Any]:
+        return global_state, jax.tree_util.tree_map(
+            lambda x: jnp.zeros(x.shape, x.dtype), outputs_shape
+        )
+
+    def body(global_state: StateGlobal, idx_step: jnp.ndarray):
+        return jax.lax.cond(
+            global_state.done | (idx_step >= n_steps), skip, step, global_state
+        )
+
+    return jax.lax.scan(body, global_state, jnp.arange(n_steps_per_chunk))
+
+
 def eco_loop(
     env: EcoEnvironment,
     agent_species: AgentSpecies,
@@ -59,6 +95,7 @@ def eco_loop(
     # Hyperparameters
     n_timesteps: int = config["n_timesteps"]
     n_agents_max = config["n_agents_max"]
+    n_steps_per_chunk: int = int(max(1, config.get("n_steps_per_chunk", 1)))
     period_video: int = int(max(1, config["period_video"]))
     t_last_video: int = -period_video
 
@@ -122,6 +159,8 @@ def eco_loop(
     #     # Log the metrics
     #     metrics_global: dict = info.get("metrics", {}).copy()
     #     metrics_global.update(get_runtime_metrics())
+    #     if do_tb or do_wandb:
+    #         metrics_global = explode_appearance(metrics_global)
     #     metrics_scalar, metrics_histogram = get_dict_metrics_by_type(metrics_global)
     #     for logger in list_loggers:
     #         logger.log_scalars(metrics_scalar, t)
@@ -132,30 +171,33 @@ def eco_loop(
 
     def step_eco_loop(x: Tuple[StateGlobal, Dict[str, Any]]) -> Tuple[StateGlobal, Dict[str, Any]]:
         global_state, info = x
-        key_random = global_state.key_random
+        # A single split per step gives the keys of the agents step, of the env step and of the next step
+        key_random, key_react, key_env = random.split(global_state.key_random, 3)
 
         # Agents step
-        key_random, subkey = random.split(key_random)
         new_state_species, actions, info_species = agent_species.react(
             state=global_state.state_species,
             batch_observations=global_state.observations,
             eco_information=global_state.eco_information,
-            key_random=subkey,
+            key_random=key_react,
         )
 
-        # Env step
-        key_random, subkey = random.split(key_random)
+        # Env step. The env measures are only consumed at the steps recorded by process_step_data_basic and process_step_data_enhanced
+        t = global_state.timestep_run
+        do_compute_measures = t % log_metrics_interval == 0
+        if do_advanced_logging:
+            do_compute_measures |= t >= enhanced_logging_start
         new_state_env, new_observations, new_eco_information, new_done, info_env = (
             env.step(
                 state=global_state.state_env,
                 actions=actions,
-                key_random=subkey,
+                key_random=key_env,
                 state_species=new_state_species,  # optional, to allow the environment to access the state of the species
+                do_compute_measures=do_compute_measures,
             )
         )
 
         # Return the new global state
-        key_random, subkey = random.split(key_random)
         metrics_env = info_env.get("metrics", {})
         metrics_species = info_species.get("metrics", {})
         metrics_global = {**metrics_env, **metrics_species}
@@ -168,7 +210,7 @@ def eco_loop(
                 eco_information=new_eco_information,
                 timestep_run=global_state.timestep_run + 1,
                 done=new_done,
-                key_random=subkey,
+                key_random=key_random,
             ),
             info
         )
@@ -249,7 +291,7 @@ def eco_loop(
         eco_information=eco_information,
         timestep_run=jnp.array(0),
         done=done,
-        key_random=subkey,
+        key_random=key_random,
     )
 
     def save_data(data_dict, filename, concat=True):
@@ -293,7 +335,7 @@ def eco_loop(
             metrics_data["prop_feed_offspring"].append(prop_feed_offspring)
             metrics_data["prop_face_offspring"].append(prop_face_offspring)
 
-    def process_step_data_enhanced(t, global_state, info):
+    def process_step_data_enhanced(t, eco_information, info):
         # process feeding data
         feeders = jnp.where(info["metrics"]["feeders"] == 1)[0].astype(jnp.int32)
         feedees = info["metrics"]["feedees"][feeders].astype(jnp.int32)
@@ -311,10 +353,10 @@ def eco_loop(
         feeding_data["timestep"].append(jnp.full_like(feeders, t))
 
         # process birth data
-        newborns = jnp.where(global_state.eco_information.are_newborns_agents == 1)[
+        newborns = jnp.where(eco_information.are_newborns_agents == 1)[
             0
         ].astype(jnp.int32)
-        parents = global_state.eco_information.indexes_parents.reshape(
+        parents = eco_information.indexes_parents.reshape(
             (n_agents_max,)
         )[newborns]
         birth_data["agent"].append(newborns)
@@ -328,54 +370,117 @@ def eco_loop(
         death_data["age"].append(life_exp[dead_agents])
         death_data["timestep"].append(jnp.full_like(dead_agents, t))
 
-    # Do (some?) first step(s) to get global_state and info at the right structure
-    for t in range(1):
-        global_state, info = step_eco_loop((global_state, info))
-        process_step_data_basic(t, info)
+    def step(
+        global_state: StateGlobal,
+    ) -> Tuple[StateGlobal, Tuple[EcoInformation, Dict[str, Any]]]:
+        global_state, info = step_eco_loop((global_state, {}))
+        return global_state, (global_state.eco_information, info)
+
+    # JIT the chunks of steps. The number of steps is a dynamic argument, so that the chunks cut short by a host event do not trigger new compilations.
+    # The shapes and dtypes of the outputs of a step are computed once outside of the compiled loop, and used to fill the outputs of the skipped steps
+    run_chunk_jitted = jax.jit(
+        partial(
+            run_chunk,
+            step,
+            n_steps_per_chunk=n_steps_per_chunk,
+            outputs_shape=jax.eval_shape(step, global_state)[1],
+        ),
+        donate_argnums=(0,),
+    )
+
+    def get_n_steps_next_chunk(t: int) -> int:
+        """Get the number of steps of the chunk starting at timestep t. The chunk ends at the first step after which the host has to render, evaluate or flush,
+        so that these events happen at the same timesteps as if the steps were performed one by one.
+        """
+        n_steps = min(n_steps_per_chunk, n_timesteps - t)
+        # The next rendering happens before the step t_last_video + period_video
+        if do_render:
+            n_steps = min(n_steps, t_last_video + period_video - t)
+        # The next evaluation and flush happen after the first step t' >= t that is a multiple of their interval (and after their start)
+        if do_eval:
+            t_eval = -(-max(t, eval_start) // eval_interval) * eval_interval
+            n_steps = min(n_steps, t_eval + 1 - t)
+        t_flush = -(-max(t, flush_interval) // flush_interval) * flush_interval
+        n_steps = min(n_steps, t_flush + 1 - t)
+        return n_steps
 
-    # JIT after first steps
-    # step_eco_loop = jax.jit(step_eco_loop)
     run_feed_selectivity_eval = jax.jit(run_feed_selectivity_eval)
 
     t = int(global_state.timestep_run)
     pbar = tqdm(total=n_timesteps, desc="Running simulation", initial=t)
-    while global_state.timestep_run < n_timesteps:
-        t = global_state.timestep_run.item()
-        if do_render and t - t_last_video >= period_video:
-            env.render(state=global_state.state_env)
-            t_last_video = t
-
-        global_state, info = step_eco_loop((global_state, info))
-
-        # record some metrics and event data
-        process_step_data_basic(t, info)
-        if do_advanced_logging and t >= enhanced_logging_start:
-            process_step_data_enhanced(t, global_state, info)
-
-        if do_eval and t >= eval_start and t % eval_interval == 0:
-            eval_results = run_feed_selectivity_eval(
-                random.PRNGKey(t),
-                global_state.state_species,
-                global_state.observations
-            )
-            jnp.save(
-                os.path.join(dir_metrics, f"eval_results_{t}.npy"),
-                eval_results
+    # The video encoding thread is shut down even if a chunk raises
+    try:
+        while t < n_timesteps:
+            # Python only runs between chunks, for rendering and logging
+            if do_render and t - t_last_video >= period_video:
+                env.render(state=global_state.state_env)
+                t_last_video = t
+
+            n_steps = get_n_steps_next_chunk(t)
+            global_state, (eco_informations, infos) = run_chunk_jitted(
+                global_state, jnp.array(n_steps)
             )
-
-        if t % flush_interval == 0 and t >= flush_interval:
-            tqdm.write(f"Saving data at timestep {t}...")
-            if do_advanced_logging and t >= enhanced_logging_start:
-                feeding_data = flush_data(feeding_data, f"feeding_data_{t}.csv")
-                birth_data = flush_data(birth_data, f"birth_data_{t}.csv")
-                death_data = flush_data(death_data, f"death_data_{t}.csv")
-            save_data(metrics_data, "metrics_data.csv", concat=False)
-
-        t_new = int(global_state.timestep_run)
-        pbar.update(t_new - t)
-        t = t_new
-
-    print("End of simulation")
+            t_new = int(global_state.timestep_run)
+            t_last = t_new - 1  # the last step performed in the chunk
+
+            # record some metrics and event data, for the steps actually performed that are logged.
+            # These steps are gathered on the device and transferred to the host in one batch per chunk
+            steps_logged = [
+                i
+                for i in range(t_new - t)
+                if (t + i) % log_metrics_interval == 0
+                or (do_advanced_logging and t + i >= enhanced_logging_start)
+            ]
+            if len(steps_logged) > 0:
+                eco_informations, infos = jax.device_get(
+                    jax.tree_util.tree_map(
+                        lambda x: x[np.array(steps_logged)], (eco_informations, infos)
+                    )
+                )
+            for j, i in enumerate(steps_logged):
+                t_step = t + i
+                info = jax.tree_util.tree_map(lambda x: x[j], infos)
+                # The appearance measure is split into one measure per dimension for the TensorBoard and WandB loggers, on the host
+                if do_tb or do_wandb:
+                    info["metrics"] = explode_appearance(info["metrics"])
+                process_step_data_basic(t_step, info)
+                if do_advanced_logging and t_step >= enhanced_logging_start:
+                    eco_information = jax.tree_util.tree_map(
+                        lambda x: x[j], eco_informations
+                    )
+                    process_step_data_enhanced(t_step, eco_information, info)
+
+            # Evaluate and flush the data after the step they are due at, which is the last step of the chunk
+            if do_eval and t_new > t and t_last >= eval_start and t_last % eval_interval == 0:
+                eval_results = run_feed_selectivity_eval(
+                    random.PRNGKey(t_last),
+                    global_state.state_species,
+                    global_state.observations
+                )
+                jnp.save(
+                    os.path.join(dir_metrics, f"eval_results_{t_last}.npy"),
+                    eval_results
+                )
+
+            if t_new > t and t_last % flush_interval == 0 and t_last >= flush_interval:
+                tqdm.write(f"Saving data at timestep {t_last}...")
+                if do_advanced_logging and t_last >= enhanced_logging_start:
+                    feeding_data = flush_data(feeding_data, f"feeding_data_{t_last}.csv")
+                    birth_data = flush_data(birth_data, f"birth_data_{t_last}.csv")
+                    death_data = flush_data(death_data, f"death_data_{t_last}.csv")
+                save_data(metrics_data, "metrics_data.csv", concat=False)
+
+            pbar.update(t_new - t)
+            t = t_new
+
+            # The done flag is only checked on the host at the end of each chunk
+            if bool(global_state.done):
+                tqdm.write(f"Environment done at timestep {t}")
+                break
+
+        print("End of simulation")
+    finally:
+        env.close()
 
     # # Close the loggers
     # for logger in list_loggers:
@@ -72,6 +72,7 @@ class EcoEnvironment(ABC):
         actions: ActionAgent, # Batched
         key_random: jnp.ndarray,
         state_species: Optional[StateSpecies] = None,
+        do_compute_measures: Union[bool, jnp.ndarray] = True,
     ) -> Tuple[
         StateEnv,
         ObservationAgent,
@@ -86,6 +87,7 @@ class EcoEnvironment(ABC):
             actions (ActionAgent): the actions of the agents at t, of attributes of shape (n_max_agents, dim_action_components)
             key_random (jnp.ndarray): the random key used for the step
             state_species (StateSpecies): the state of the species of agents at t (optional)
+            do_compute_measures (Union[bool, jnp.ndarray]): whether the measures of this step are consumed and should be computed (optional, defaults to True)
 
         Returns:
             state_new (StateEnv): the new state of the environment at t+1
@@ -122,6 +124,11 @@ class EcoEnvironment(ABC):
         """
         return
 
+    def close(self) -> None:
+        """Release the resources of the environment, e.g. wait for the renderings still in progress. This should be called once the simulation is over.
+        """
+        return
+
     def compute_on_render_behavior_measures(
         self,
         state_species: StateSpecies,
@@ -1,16 +1,17 @@
 # Gridworld EcoJAX environment
 
 from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import partial
+import math
 import os
 from time import sleep
-from typing import Any, Callable, Dict, List, Optional, Tuple, Type, TypeVar
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple, Type, TypeVar, Union
 
 import jax
 import jax.numpy as jnp
 import numpy as np
 from jax import random
-from jax.scipy.signal import convolve2d
 from flax.struct import PyTreeNode, dataclass
 from jax.debug import breakpoint as jbreakpoint
 from tqdm import tqdm
@@ -26,8 +27,6 @@ from ecojax.utils import (
     instantiate_class,
     jprint,
     jprint_and_breakpoint,
-    sigmoid,
-    logit,
     try_get,
 )
 from ecojax.video import VideoRecorder
@@ -36,24 +35,24 @@ from ecojax.video import VideoRecorder
 @dataclass
 class AgentGridworld:
     # Where the agents are, of shape (n_max_agents, 2). positions_agents[i, :] represents the (x,y) coordinates of the i-th agent in the map. Ghost agents are still represented in the array (in position (0,0)).
-    positions_agents: jnp.ndarray  # (n_max_agents, 2) in [0, height-1] x [0, width-1]
+    positions_agents: jnp.ndarray  # (n_max_agents, 2) in [0, height-1] x [0, width-1], int16
     # The orientation of the agents, of shape (n_max_agents,) and of values in {0, 1, 2, 3}. orientation_agents[i] represents the index of its orientation in the env.
     # The orientation of an agent will have an impact on the way the agent's surroundings are perceived, because a certain rotation will be performed on the agent's vision in comparison to the traditional map[x-v:x+v+1, y-v:y+v+1, :] vision.
     # The angle the agent is facing is given by orientation_agents[i] * 90 degrees (modulo 360 degrees), where 0 is facing north.
-    orientation_agents: jnp.ndarray  # (n_max_agents,) in {0, 1, 2, 3}
+    orientation_agents: jnp.ndarray  # (n_max_agents,) in {0, 1, 2, 3}, uint8
     # Whether the agents exist or not, of shape (n_max_agents,) and of values in {0, 1}. are_existing_agents[i] represents whether the i-th agent actually exists in the environment and should interact with it.
     # An non existing agent is called a Ghost Agent and is only kept as a placeholder in the positions_agents array, in order to keep the array of positions_agents of shape (n_max_agents, 2).
-    are_existing_agents: jnp.ndarray  # (n_max_agents,) in {0, 1}
+    are_existing_agents: jnp.ndarray  # (n_max_agents,) in {0, 1}, bool
     # The energy level of the agents, of shape (n_max_agents,). energy_agents[i] represents the energy level of the i-th agent.
-    energy_agents: jnp.ndarray  # (n_max_agents,) in [0, +inf)
+    energy_agents: jnp.ndarray  # (n_max_agents,) in [0, +inf), float32
     # The age of the agents
-    age_agents: jnp.ndarray  # (n_max_agents,) in [0, +inf)
+    age_agents: jnp.ndarray  # (n_max_agents,) in [0, +inf), int32
     # The appearance of the agent, encoded as a vector in R^dim_appearance. appearance_agents[i, :] represents the appearance of the i-th agent.
     # The appearance of an agent allows the agents to distinguish their genetic proximity, as agents with similar appearances are more likely to be genetically close.
     # By convention : a non-agent has an appearance of zeros, the common ancestors have an appearance of ones, and m superposed agents have an appearance of their average.
-    appearance_agents: jnp.ndarray  # (n_max_agents, dim_appearance) in R
-    # The index of the parent of each agent
-    parent_agents: jnp.ndarray  # (n_max_agents,) in {0, 1, ..., n_max_agents-1}
+    appearance_agents: jnp.ndarray  # (n_max_agents, dim_appearance) in R, float32
+    # The index of the parent of each agent. Agents without a parent (e.g. the initial ones) have the parent index n_max_agents.
+    parent_agents: jnp.ndarray  # (n_max_agents,) in {0, 1, ..., n_max_agents}, int32
 
 
 @dataclass
@@ -67,8 +66,20 @@ class StateEnvGridworld(StateEnv):
     # The current timestep of the environment
     timestep: int
 
-    # The current map of the environment, of shape (H, W, C) where C is the number of channels used to represent the environment
-    map: jnp.ndarray  # (height, width, dim_tile) in R
+    # The current map of the environment, stored as one plane per channel (or group of channels) with its own dtype. The full (H, W, C) map can be assembled with GridworldEnv.get_map
+    # The effect of the sun on each tile
+    map_sun: jnp.ndarray  # (height, width) in [0, 1], float32
+    # Whether there is a plant on each tile
+    map_plants: jnp.ndarray  # (height, width), bool
+    # The number of agents on each tile
+    map_agents: jnp.ndarray  # (height, width) in {0, ..., n_agents_max}, int32
+    # The average age of the agents on each tile
+    map_agent_ages: jnp.ndarray  # (height, width) in R+, float32
+    # The average appearance of the agents on each tile
+    map_appearances: jnp.ndarray  # (height, width, dim_appearance) in R, float32
+
+    # The number of existing agents, kept up to date by the step so that it is not recounted for the measures
+    n_agents: jnp.ndarray  # () in {0, ..., n_agents_max}, int32
 
     # The latitude of the sun (the row of the map where the sun is). It represents entirely the sun location.
     latitude_sun: int
@@ -80,8 +91,8 @@ class StateEnvGridworld(StateEnv):
     metrics_lifespan: List[PyTreeNode]
     metrics_population: List[PyTreeNode]
 
-    # The last n_steps_per_video frames of the video
-    video: jnp.ndarray  # (n_steps_per_video, height, width, 3) in [0, 1]
+    # The last n_steps_per_video frames of the video, or an empty placeholder if no video is recorded
+    video: jnp.ndarray  # (n_steps_per_video, height, width, 3) in [0, 255], uint8, or (0,)
 
 
 class GridworldEnv(EcoEnvironment):
@@ -143,14 +154,16 @@ class GridworldEnv(EcoEnvironment):
         # Environment Parameters
         self.width: int = config["width"]
         self.height: int = config["height"]
+        self.n_tiles: int = self.height * self.width
         self.is_terminal: bool = config["is_terminal"]
         self.allow_multiple_agents_per_tile = config.get(
             "allow_multiple_agents_per_tile", True
         )
         self.period_logging: int = int(max(1, self.config["period_logging"]))
+        self.dim_appearance: int = int(config["dim_appearance"])
         self.list_names_channels: List[str] = ["sun", "plants", "agents", "agent_ages"]
         self.list_names_channels += [
-            f"appearance_{i}" for i in range(config["dim_appearance"])
+            f"appearance_{i}" for i in range(self.dim_appearance)
         ]
         self.dict_name_channel_to_idx: Dict[str, int] = {
             name_channel: idx_channel
@@ -170,11 +183,29 @@ class GridworldEnv(EcoEnvironment):
             )
         }
         self.n_channels_visual_field: int = len(self.list_indexes_channels_visual_field)
+        self.list_names_channels_visual_field: List[str] = config[
+            "list_channels_visual_field"
+        ]
+        # The index of the agent_ages channel in the visual field, where the agents see whether each tile holds an infant, or None if the agents do not see it
+        self.idx_agent_ages_visual_field: Optional[int] = (
+            self.list_names_channels_visual_field.index("agent_ages")
+            if "agent_ages" in self.list_names_channels_visual_field
+            else None
+        )
 
         # Metrics parameters
         self.names_measures: List[str] = sum(
             [names for type_measure, names in config["metrics"]["measures"].items()], []
         )
+        # The names of the population-level measures, which are not masked per agent. The group_size measure is logged as an average and a max
+        names_measures_environmental: List[str] = list(
+            config["metrics"]["measures"]["environmental"]
+        )
+        if "group_size" in names_measures_environmental:
+            names_measures_environmental += ["average_group_size", "max_group_size"]
+        self.names_measures_environmental: FrozenSet[str] = frozenset(
+            names_measures_environmental
+        )
 
         # Video parameters
         self.cfg_video = config["metrics"]["config_video"]
@@ -184,6 +215,22 @@ class GridworldEnv(EcoEnvironment):
         self.dir_videos: str = self.cfg_video["dir_videos"]
         self.height_max_video: int = self.cfg_video["height_max_video"]
         self.width_max_video: int = self.cfg_video["width_max_video"]
+        # The shape of the video buffer kept in the state. If no video is recorded, an empty placeholder is kept instead.
+        self.shape_video: Tuple[int, ...] = (
+            (self.n_steps_per_video, self.height, self.width, 3)
+            if self.do_video
+            else (0,)
+        )
+        # The frames of the video are upscaled by the largest integer factor fitting in the maximum video size
+        self.upscale_factor_video: int = int(
+            min(self.height_max_video / self.height, self.width_max_video / self.width)
+        )
+        assert (
+            not self.do_video or self.upscale_factor_video >= 1
+        ), "The upscale factor must be at least 1"
+        # The videos are encoded in a background thread, so that the simulation continues during the encoding. The future of the last encoding is kept to surface its errors
+        self.executor_video = ThreadPoolExecutor(max_workers=1) if self.do_video else None
+        self.future_video: Optional[Future] = None
         self.dict_name_channel_to_color_tag: Dict[str, str] = self.cfg_video[
             "dict_name_channel_to_color_tag"
         ]
@@ -206,17 +253,58 @@ class GridworldEnv(EcoEnvironment):
                 self.dict_idx_channel_to_color_tag[idx_channel] = (
                     self.color_tag_unknown_channel
                 )
+        # The RGB color of each channel, of shape (n_channels_map, 3), and whether each channel is drawn on the RGB map, of shape (n_channels_map,)
+        self.colors_channels = jnp.array(
+            [
+                DICT_COLOR_TAG_TO_RGB[self.dict_idx_channel_to_color_tag[idx_channel]]
+                for idx_channel in range(self.n_channels_map)
+            ],
+            dtype=jnp.float32,
+        )
+        self.are_channels_colored = jnp.array(
+            [
+                name_channel in self.dict_name_channel_to_color_tag
+                for name_channel in self.list_names_channels
+            ],
+            dtype=jnp.bool_,
+        )
 
         # Sun Parameters
         self.period_sun: int = config["period_sun"]
         self.method_sun: str = config["method_sun"]
         self.radius_sun_effect: int = config["radius_sun_effect"]
         self.radius_sun_perception: int = config["radius_sun_perception"]
+        if self.method_sun != "none":
+            # The effect of the sun on each latitude when the sun is at the middle latitude, of shape (height, 1). It is constant so we compute it once here.
+            latitudes = np.arange(self.height)
+            distance_from_sun = np.minimum(
+                np.abs(latitudes - self.height // 2),
+                self.height - np.abs(latitudes - self.height // 2),
+            )
+            self.sun_effect = jnp.asarray(
+                np.clip(1 - distance_from_sun / self.radius_sun_effect, 0, 1),
+                dtype=jnp.float32,
+            )[:, None]
 
         # Plants Dynamics
         self.proportion_plant_initial: float = config["proportion_plant_initial"]
-        self.logit_p_base_plant_growth: float = logit(config["p_base_plant_growth"])
-        self.logit_p_base_plant_death: float = logit(config["p_base_plant_death"])
+        # The logits and probabilities are computed on the host as Python floats, so that they are constants of the traced step
+        eps = 1e-8
+        p_base_plant_growth = min(max(config["p_base_plant_growth"], eps), 1 - eps)
+        p_base_plant_death = min(max(config["p_base_plant_death"], eps), 1 - eps)
+        self.logit_p_base_plant_growth: float = math.log(
+            p_base_plant_growth / (1 - p_base_plant_growth)
+        )
+        self.logit_p_base_plant_death: float = math.log(
+            p_base_plant_death / (1 - p_base_plant_death)
+        )
+        # The probabilities for a plant to appear on an empty tile and to stay on its tile at each step. The plants map is binary, so they are constant
+        self.p_plant_growth: float = 1 / (
+            1 + math.exp(-min(max(self.logit_p_base_plant_growth, -10), 10))
+        )
+        self.p_plant_survival: float = 1 / (
+            1 + math.exp(-min(max(1 - self.logit_p_base_plant_death, -10), 10))
+        )
         self.factor_sun_effect: float = config["factor_sun_effect"]
         self.factor_plant_reproduction: float = config["factor_plant_reproduction"]
         self.radius_plant_reproduction: int = config["radius_plant_reproduction"]
@@ -224,12 +312,14 @@ class GridworldEnv(EcoEnvironment):
             (
                 config["radius_plant_reproduction"],
                 config["radius_plant_reproduction"],
-            )
+            ),
+            dtype=jnp.float32,
         ) / (config["radius_plant_reproduction"] ** 2)
         self.factor_plant_asphyxia: float = config["factor_plant_asphyxia"]
         self.radius_plant_asphyxia: int = config["radius_plant_asphyxia"]
         self.kernel_plant_asphyxia = jnp.ones(
-            (config["radius_plant_asphyxia"], config["radius_plant_asphyxia"])
+            (config["radius_plant_asphyxia"], config["radius_plant_asphyxia"]),
+            dtype=jnp.float32,
         ) / (config["radius_plant_asphyxia"] ** 2)
 
         # ======================== Agent Parameters ========================
@@ -260,10 +350,20 @@ class GridworldEnv(EcoEnvironment):
         observation_dict = {}
         if "visual_field" in self.list_observations:
             self.vision_range_agent: int = config["vision_range_agent"]
-            self.grid_indexes_vision_x, self.grid_indexes_vision_y = jnp.meshgrid(
-                jnp.arange(-self.vision_range_agent, self.vision_range_agent + 1),
-                jnp.arange(-self.vision_range_agent, self.vision_range_agent + 1),
-                indexing="ij",
+            # The offsets of the tiles of the visual field relative to the agent, of shape (2v+1, 2v+1). They are kept as host constants so that XLA can fold them in the gathers.
+            v = self.vision_range_agent
+            self.grid_indexes_vision_x, self.grid_indexes_vision_y = np.mgrid[
+                -v : v + 1, -v : v + 1
+            ].astype(np.int32)
+            # The offsets of the visual field once rotated according to each orientation, of shape (4, 2, 2v+1, 2v+1) : an agent of orientation o sees the tile at the offsets [o, :, i, j] in the cell (i, j) of its visual field
+            gx, gy = self.grid_indexes_vision_x, self.grid_indexes_vision_y
+            self.grid_indexes_vision_by_orientation = np.stack(
+                [
+                    np.stack([gx, gy]),
+                    np.stack([-gy, gx]),  # if we turn left, the observation should be rotated right, eg 270 degrees
+                    np.stack([-gx, -gy]),
+                    np.stack([gy, -gx]),
+                ]
             )
             observation_dict["visual_field"] = ContinuousSpace(
                 shape=(
@@ -287,6 +387,63 @@ class GridworldEnv(EcoEnvironment):
             action: idx for idx, action in enumerate(self.list_actions)
         }
         self.n_actions = len(self.list_actions)
+        # The move (dx, dy) of an agent going forward, for each orientation, of shape (4, 2)
+        self.d_positions_by_orientation = np.array(
+            [[1, 0], [0, -1], [-1, 0], [0, 1]], dtype=np.int32
+        )
+        # The change of orientation caused by each action, of shape (n_actions,) : turning left adds 1 and turning right adds 3 (modulo 4)
+        self.d_orientation_by_action = np.zeros(self.n_actions, dtype=np.int32)
+        for name_action, d_orientation in [("left", 1), ("right", 3)]:
+            if name_action in self.action_to_idx:
+                self.d_orientation_by_action[self.action_to_idx[name_action]] = d_orientation
+
+        # The handlers of the measures computed by compute_measures, selected once from the measure names. Each handler maps (state, actions) to a dictionary of measures.
+        # Measures computed in other parts of the code have no handler
+        dict_name_measure_to_handler: Dict[
+            str, Callable[[StateEnvGridworld, jnp.ndarray], Dict[str, jnp.ndarray]]
+        ] = {
+            # Environment measures
+            "n_agents": lambda state, actions: {"n_agents": state.n_agents},
+            # The plants map is entirely resampled at each step, so the plants are counted only when the measure is computed
+            "n_plants": lambda state, actions: {"n_plants": jnp.sum(state.map_plants)},
+            "group_size": lambda state, actions: self.compute_group_size_measures(state),
+            # State measures
+            "energy": lambda state, actions: {"energy": state.agents.energy_agents},
+            "age": lambda state, actions: {"age": state.agents.age_agents},
+            "appearance": lambda state, actions: {
+                "appearance": state.agents.appearance_agents
+            },
+        }
+        self.measure_handlers: Dict[
+            str, Callable[[StateEnvGridworld, jnp.ndarray], Dict[str, jnp.ndarray]]
+        ] = {
+            name_measure: dict_name_measure_to_handler[name_measure]
+            for name_measure in self.names_measures
+            if name_measure in dict_name_measure_to_handler
+        }
+        # Immediate measures : the do_action_ measures share a single handler, that computes the one-hot encoding of the actions once
+        dict_name_measure_to_idx_action = {
+            name_measure: self.action_to_idx[name_measure[len("do_action_") :]]
+            for name_measure in self.names_measures
+            if name_measure.startswith("do_action_")
+            and name_measure[len("do_action_") :] in self.list_actions
+        }
+        if len(dict_name_measure_to_idx_action) > 0:
+            self.measure_handlers["do_action"] = partial(
+                self.compute_do_action_measures,
+                dict_name_measure_to_idx_action=dict_name_measure_to_idx_action,
+            )
+        # The x and y measures share a single handler, that reads the positions of the agents once
+        dict_name_measure_to_idx_coordinate = {
+            name_measure: idx_coordinate
+            for idx_coordinate, name_measure in enumerate(["x", "y"])
+            if name_measure in self.names_measures
+        }
+        if len(dict_name_measure_to_idx_coordinate) > 0:
+            self.measure_handlers["positions"] = partial(
+                self.compute_position_measures,
+                dict_name_measure_to_idx_coordinate=dict_name_measure_to_idx_coordinate,
+            )
 
         # Agent's internal dynamics
         self.age_max: int = config["age_max"]
@@ -307,7 +464,10 @@ class GridworldEnv(EcoEnvironment):
 
         # Other
         self.fill_value: int = self.n_agents_max
+        # The indexes of the agents, of shape (n_agents_max,)
+        self.indexes_agents = jnp.arange(self.n_agents_max, dtype=jnp.int32)
 
+    @partial(jax.jit, static_argnums=(0,))
     def reset(
         self,
         key_random: jnp.ndarray,
@@ -318,61 +478,51 @@ class GridworldEnv(EcoEnvironment):
         bool,
         Dict[str, Any],
     ]:
-        idx_sun = self.dict_name_channel_to_idx["sun"]
-        idx_plants = self.dict_name_channel_to_idx["plants"]
-        idx_agents = self.dict_name_channel_to_idx["agents"]
         H, W = self.height, self.width
 
-        # Initialize the map
-        map = jnp.zeros(shape=(H, W, self.n_channels_map))
-
         # Initialize the sun
         if self.method_sun != "none":
             latitude_sun = H // 2
-            latitudes = jnp.arange(H)
-            distance_from_sun = jnp.minimum(
-                jnp.abs(latitudes - latitude_sun),
-                H - jnp.abs(latitudes - latitude_sun),
-            )
-            effect = jnp.clip(1 - distance_from_sun / self.radius_sun_effect, 0, 1)
-            effect_map = jnp.repeat(effect[:, None], W, axis=1)
-            map = map.at[:, :, idx_sun].set(effect_map)
+            map_sun = jnp.broadcast_to(self.sun_effect, (H, W))
         else:
             latitude_sun = None
+            map_sun = jnp.zeros((H, W), dtype=jnp.float32)
 
         # Initialize the plants
         key_random, subkey = jax.random.split(key_random)
-        map = map.at[:, :, idx_plants].set(
-            jax.random.bernoulli(
-                key=subkey,
-                p=self.proportion_plant_initial,
-                shape=(H, W),
-            )
+        map_plants = jax.random.bernoulli(
+            key=subkey,
+            p=self.proportion_plant_initial,
+            shape=(H, W),
         )
 
         # Initialize the agents
         key_random, subkey = jax.random.split(key_random)
-        are_existing_agents = jnp.array(
-            [i < self.n_agents_initial for i in range(self.n_agents_max)],
-            dtype=jnp.bool_,
-        )
+        are_existing_agents = self.indexes_agents < self.n_agents_initial
 
-        pos_indices = jax.random.choice(
-            key=subkey,
-            a=H * W,
-            shape=(self.n_agents_max,),
-            replace=False,
-        )
+        if self.allow_multiple_agents_per_tile:
+            # Agents may share tiles, so positions can be sampled independently without materializing a permutation of the H*W tiles
+            pos_indices = jax.random.randint(
+                key=subkey,
+                shape=(self.n_agents_max,),
+                minval=0,
+                maxval=H * W,
+            )
+        else:
+            pos_indices = jax.random.choice(
+                key=subkey,
+                a=H * W,
+                shape=(self.n_agents_max,),
+                replace=False,
+            )
         positions_agents = jnp.stack(
             [pos_indices // W, pos_indices % W],
             axis=-1,
-        )
+        ).astype(jnp.int16)
 
-        map = map.at[
-            positions_agents[:, 0],
-            positions_agents[:, 1],
-            idx_agents,
-        ].add(are_existing_agents)
+        map_agents = self.sum_per_tile(
+            self.get_tiles(positions_agents), are_existing_agents.astype(jnp.int32)
+        )
 
         key_random, subkey = jax.random.split(key_random)
         orientation_agents = jax.random.randint(
@@ -380,15 +530,18 @@ class GridworldEnv(EcoEnvironment):
             shape=(self.n_agents_max,),
             minval=0,
             maxval=4,
+            dtype=jnp.int32,
+        ).astype(jnp.uint8)
+        energy_agents = jnp.full(
+            (self.n_agents_max,), self.energy_initial, dtype=jnp.float32
         )
-        energy_agents = jnp.ones(self.n_agents_max) * self.energy_initial
-        age_agents = jnp.zeros(self.n_agents_max)
+        age_agents = jnp.zeros(self.n_agents_max, dtype=jnp.int32)
         appearance_agents = (
-            jnp.zeros((self.n_agents_max, self.config["dim_appearance"]))
+            jnp.zeros((self.n_agents_max, self.dim_appearance))
             .at[: self.n_agents_initial, :]
             .set(1)
         )
-        parent_agents = jnp.zeros(self.n_agents_max) + self.fill_value
+        parent_agents = jnp.full((self.n_agents_max,), self.fill_value, dtype=jnp.int32)
 
         # Initialize the state
         agents = AgentGridworld(
@@ -417,12 +570,14 @@ class GridworldEnv(EcoEnvironment):
             list_metrics_population.append(agg.get_initial_metrics())
 
         # Initialize the video memory
-        video = jnp.zeros((self.n_steps_per_video, H, W, 3))
+        video = jnp.zeros(self.shape_video, dtype=jnp.uint8)
 
         # Initialize ecological informations
         are_newborns_agents = jnp.zeros(self.n_agents_max, dtype=jnp.bool_)
         are_dead_agents = jnp.zeros(self.n_agents_max, dtype=jnp.bool_)
-        indexes_parents_agents = jnp.full((self.n_agents_max, 1), self.fill_value)
+        indexes_parents_agents = jnp.full(
+            (self.n_agents_max, 1), self.fill_value, dtype=jnp.int32
+        )
         eco_information = EcoInformation(
             are_newborns_agents=are_newborns_agents,
             indexes_parents=indexes_parents_agents,
@@ -432,7 +587,14 @@ class GridworldEnv(EcoEnvironment):
         # Initialize the state
         state = StateEnvGridworld(
             timestep=0,
-            map=map,
+            map_sun=map_sun,
+            map_plants=map_plants,
+            map_agents=map_agents,
+            map_agent_ages=jnp.zeros((H, W), dtype=jnp.float32),
+            map_appearances=jnp.zeros(
+                (H, W, self.dim_appearance), dtype=jnp.float32
+            ),
+            n_agents=jnp.array(self.n_agents_initial, dtype=jnp.int32),
             latitude_sun=latitude_sun,
             agents=agents,
             metrics_lifespan=list_metrics_lifespan,
@@ -443,8 +605,6 @@ class GridworldEnv(EcoEnvironment):
         # Return the information required by the agents
         observations_agents, _ = self.get_observations_agents(state=state)
 
-        print(f"observations shape: {observations_agents['visual_field'].shape}")
-
         return (
             state,
             observations_agents,
@@ -453,12 +613,14 @@ class GridworldEnv(EcoEnvironment):
             {},
         )
 
+    @partial(jax.jit, static_argnums=(0,), donate_argnames=("state",))
     def step(
         self,
         state: StateEnvGridworld,
         actions: jnp.ndarray,
         key_random: jnp.ndarray,
         state_species: Optional[StateSpecies] = None,
+        do_compute_measures: Union[bool, jnp.ndarray] = True,
     ) -> Tuple[
         StateEnvGridworld,
         ObservationAgent,
@@ -467,11 +629,13 @@ class GridworldEnv(EcoEnvironment):
         Dict[str, Any],
     ]:
         """A step of the environment. This function will update the environment according to the actions of the agents.
+        The buffers of the given state are donated to the new state, so that XLA can update them in place : the given state should not be used after this call.
 
         Args:
             state (StateEnvGridworld): the state of the environment at timestep t
             actions (jnp.ndarray): the actions of the agents reacting to the environment at timestep t
             key_random (jnp.ndarray): the random key used to generate random numbers
+            do_compute_measures (Union[bool, jnp.ndarray]): whether to compute the measures of compute_measures at this step. If False, they are filled with NaN (or 0 for non-float measures)
 
         Returns:
             state_new (StateEnvGridworld): the new state of the environment at timestep t+1
@@ -485,36 +649,30 @@ class GridworldEnv(EcoEnvironment):
             info (Dict[str, Any]): additional information about the environment at timestep t
         """
 
-        H, W, C = state.map.shape
-        idx_agents = self.dict_name_channel_to_idx["agents"]
-
         # Helper func to update agent map
         def update_agent_map(state: StateEnvGridworld) -> StateEnvGridworld:
-            map_agents_new = (
-                jnp.zeros((H, W))
-                .at[
-                    state.agents.positions_agents[:, 0],
-                    state.agents.positions_agents[:, 1],
-                ]
-                .add(state.agents.are_existing_agents)
+            map_agents_new = self.sum_per_tile(
+                self.get_tiles(state.agents.positions_agents),
+                state.agents.are_existing_agents.astype(jnp.int32),
             )
-            return state.replace(map=state.map.at[:, :, idx_agents].set(map_agents_new))
+            return state.replace(map_agents=map_agents_new)
 
         # Initialize the measures dictionnary. This will be used to store the measures of the environment at this step.
         dict_measures_all: Dict[str, jnp.ndarray] = {}
         t = state.timestep
 
+        # Split the random key once for the stages of the step
+        key_action, key_reproduce, key_measures = jax.random.split(key_random, 3)
+
         # ============ (1) Agents interaction with the environment ============
         # Apply the actions of the agents on the environment
-        key_random, subkey = jax.random.split(key_random)
         state_new, dict_measures = self.step_action_agents(
-            state=state, actions=actions, key_random=subkey
+            state=state, actions=actions, key_random=key_action
         )
         dict_measures_all.update(dict_measures)
         state_new = update_agent_map(state_new)
 
         # ============ (2) Agents reproduce ============
-        key_random, subkey = jax.random.split(key_random)
         (
             state_new,
             agents_reprod,
@@ -522,41 +680,42 @@ class GridworldEnv(EcoEnvironment):
             indexes_parents_agents,
             dict_measures,
         ) = self.step_reproduce_agents(
-            state=state_new, actions=actions, key_random=subkey
+            state=state_new, actions=actions, key_random=key_reproduce
         )
         dict_measures["are_newborns"] = are_newborns_agents
         dict_measures_all.update(dict_measures)
-        state_new = update_agent_map(state_new)
 
         # ============ (3) Extract the observations of the agents (and some updates) ============
-        # update agent ages in map
-        norm_factor = jnp.maximum(1, state.map[..., idx_agents])
-        map_ages_new = (
-            jnp.zeros((H, W))
-            .at[
-                state.agents.positions_agents[:, 0],
-                state.agents.positions_agents[:, 1],
-            ]
-            .add(state.agents.age_agents * state.agents.are_existing_agents)
-            / norm_factor
-        )
-
-        # Recreate the map of appearances
-        map_appearances_new = jnp.zeros((H, W, self.config["dim_appearance"])).at[
-            state.agents.positions_agents[:, 0],
-            state.agents.positions_agents[:, 1],
-            :,
-        ].add(
-            state.agents.appearance_agents * state.agents.are_existing_agents[:, None]
-        ) / norm_factor.reshape(
-            (H, W, 1)
+        # Update the agents, agent ages and agent appearances maps : the number of agents, the sum of their ages and the sum of their appearances on each tile are computed in one scatter over the agents after reproduction
+        agents_new = state_new.agents
+        are_existing_agents = agents_new.are_existing_agents
+        values_per_tile = self.sum_per_tile(
+            self.get_tiles(agents_new.positions_agents),
+            jnp.where(
+                are_existing_agents[:, None],
+                jnp.concatenate(
+                    [
+                        jnp.ones((self.n_agents_max, 1), dtype=jnp.float32),
+                        agents_new.age_agents[:, None].astype(jnp.float32),
+                        agents_new.appearance_agents,
+                    ],
+                    axis=-1,
+                ),
+                0,
+            ),
+        )  # (H, W, 2 + dim_appearance)
+        map_agents_new = values_per_tile[:, :, 0]
+        inv_norm_factor = jnp.where(
+            map_agents_new > 0, jnp.reciprocal(jnp.maximum(1, map_agents_new)), 0
         )
+        map_ages_new = values_per_tile[:, :, 1] * inv_norm_factor
+        map_appearances_new = values_per_tile[:, :, 2:] * inv_norm_factor[:, :, None]
 
         # Update the state
-        map_new = state_new.map.at[:, :, idx_agents + 1].set(map_ages_new)
-        map_new = map_new.at[:, :, idx_agents + 2 :].set(map_appearances_new)
         state_new: StateEnvGridworld = state_new.replace(
-            map=map_new,
+            map_agents=map_agents_new.astype(jnp.int32),
+            map_agent_ages=map_ages_new,
+            map_appearances=map_appearances_new,
             timestep=t + 1,
             agents=state_new.agents.replace(age_agents=state_new.agents.age_agents + 1),
         )
@@ -568,9 +727,8 @@ class GridworldEnv(EcoEnvironment):
         dict_measures_all.update(dict_measures)
 
         # ============ (4) Get the ecological information ============
-        are_just_dead_agents = state.agents.are_existing_agents & (
-            ~state_new.agents.are_existing_agents
-            | (state_new.agents.age_agents < state_new.agents.age_agents)
+        are_just_dead_agents = (
+            state.agents.are_existing_agents & ~state_new.agents.are_existing_agents
         )
         eco_information = EcoInformation(
             are_newborns_agents=are_newborns_agents,
@@ -580,26 +738,51 @@ class GridworldEnv(EcoEnvironment):
 
         # ============ (5) Check if the environment is done ============
         if self.is_terminal:
-            done = ~jnp.any(state_new.agents.are_existing_agents)
+            done = state_new.n_agents == 0
         else:
             done = False
 
         # ============ (6) Compute the metrics ============
         # Compute some measures
-        dict_measures = self.compute_measures(
-            state=state,
-            actions=actions,
-            state_new=state_new,
-            key_random=subkey,
-            state_species=state_species,
-        )
+        def compute_measures(_) -> Dict[str, jnp.ndarray]:
+            return self.compute_measures(
+                state=state,
+                actions=actions,
+                state_new=state_new,
+                key_random=key_measures,
+                state_species=state_species,
+            )
+
+        # The measures are only computed at the steps where they are consumed, if this is known by the caller
+        if do_compute_measures is True:
+            dict_measures = compute_measures(None)
+        else:
+            # The shapes and dtypes of the measures, evaluated abstractly at trace time, to fill the skipped measures
+            shape_measures = jax.eval_shape(compute_measures, None)
+
+            def skip_measures(_) -> Dict[str, jnp.ndarray]:
+                return jax.tree_util.tree_map(
+                    lambda x: jnp.full(
+                        x.shape,
+                        jnp.nan if jnp.issubdtype(x.dtype, jnp.floating) else 0,
+                        dtype=x.dtype,
+                    ),
+                    shape_measures,
+                )
+
+            dict_measures = jax.lax.cond(
+                do_compute_measures, compute_measures, skip_measures, None
+            )
         dict_measures_all.update(dict_measures)
 
         # Set the measures to NaN for the agents that are not existing
         for name_measure, measures in dict_measures_all.items():
-            if name_measure not in self.config["metrics"]["measures"]["environmental"]:
+            if name_measure not in self.names_measures_environmental:
+                are_existing_agents = state_new.agents.are_existing_agents
                 dict_measures_all[name_measure] = jnp.where(
-                    state_new.agents.are_existing_agents,
+                    are_existing_agents.reshape(
+                        are_existing_agents.shape + (1,) * (measures.ndim - 1)
+                    ),
                     measures,
                     jnp.nan,
                 )
@@ -611,24 +794,20 @@ class GridworldEnv(EcoEnvironment):
         info = {"metrics": dict_measures_all}
 
         # ============ (7) Manage the video ============
-        # Reset the video to empty if t = 0 mod n_steps_per_video
-        video = jax.lax.cond(
-            t % self.n_steps_per_video == 0,
-            lambda _: jnp.zeros((self.n_steps_per_video, H, W, 3)),
-            lambda _: state_new.video,
-            operand=None,
-        )
-        # Add the new frame to the video
-        rgb_map = self.get_RGB_map(images=state_new.map)
-
-        # # save rgb_map as an image
-        # rgb_map = np.array(rgb_map)
-        # img = Image.fromarray((rgb_map * 255).astype(np.uint8))
-        # img.save(f"{self.dir_videos}/{t}.png")
-
-        video = state_new.video.at[t % self.n_steps_per_video].set(rgb_map)
-        # Update the state
-        state_new = state_new.replace(video=video)
+        # The video is a ring buffer of the last n_steps_per_video frames : each new frame overwrites the oldest one, so no reset is needed
+        if self.do_video:
+            rgb_map = self.get_RGB_map(images=self.get_map(state_new))
+
+            # # save rgb_map as an image
+            # rgb_map = np.array(rgb_map)
+            # img = Image.fromarray((rgb_map * 255).astype(np.uint8))
+            # img.save(f"{self.dir_videos}/{t}.png")
+
+            video = state_new.video.at[t % self.n_steps_per_video].set(
+                (rgb_map * 255).astype(jnp.uint8)
+            )
+            # Update the state
+            state_new = state_new.replace(video=video)
 
         # Return the new state and observations
         return (
@@ -639,6 +818,40 @@ class GridworldEnv(EcoEnvironment):
             info,
         )
 
+    @partial(jax.jit, static_argnums=(0,), donate_argnames=("state",))
+    def rollout(
+        self,
+        state: StateEnvGridworld,
+        keys_random: jnp.ndarray,
+        actions: jnp.ndarray,
+    ) -> Tuple[
+        StateEnvGridworld,
+        Tuple[ObservationAgent, EcoInformation, bool, Dict[str, Any]],
+    ]:
+        """Perform several steps of the environment in a single compiled loop, with the actions of the agents known in advance.
+        As for step, the buffers of the given state are donated and the given state should not be used after this call.
+
+        Args:
+            state (StateEnvGridworld): the state of the environment at timestep t
+            keys_random (jnp.ndarray): the random keys used at each step, of shape (n_steps, 2)
+            actions (jnp.ndarray): the actions of the agents at each step, of shape (n_steps, n_agents_max)
+
+        Returns:
+            state_new (StateEnvGridworld): the state of the environment at timestep t+n_steps
+            (observations_agents, eco_information, done, info): the outputs of each step, stacked along a leading (n_steps,) axis
+        """
+
+        def step_fn(
+            state: StateEnvGridworld, key_and_actions: Tuple[jnp.ndarray, jnp.ndarray]
+        ):
+            key_random, actions = key_and_actions
+            state_new, observations_agents, eco_information, done, info = self.step(
+                state=state, actions=actions, key_random=key_random
+            )
+            return state_new, (observations_agents, eco_information, done, info)
+
+        return jax.lax.scan(step_fn, state, (keys_random, actions))
+
     def get_observation_space(self) -> DictSpace:
         return self.observation_space
 
@@ -647,24 +860,89 @@ class GridworldEnv(EcoEnvironment):
 
     def render(self, state: StateEnvGridworld) -> None:
         """The rendering function of the environment. It saves the RGB map of the environment as a video."""
-        if not self.cfg_video["do_video"]:
+        if not self.do_video:
             return
         t = state.timestep
         if t < self.n_steps_per_video:
             return  # Not enough frames to render a video
 
         tqdm.write(f"Rendering video at timestep {t}...")
-        video_writer = VideoRecorder(
-            filename=f"{self.dir_videos}/video_t{t}.mp4",
-            fps=self.fps_video,
+        # Transfer the (small) frames to the host and upscale them there, so that the upscaled video is never materialized on the device.
+        # The ring buffer is rolled so that the frames are in chronological order, the oldest frame being at index t % n_steps_per_video
+        images = self.upscale_image(
+            np.roll(np.asarray(state.video), -(int(t) % self.n_steps_per_video), axis=0)
         )
-        for t_ in range(self.n_steps_per_video):
-            image = state.video[t_]
-            image = self.upscale_image(image)
+        # Wait for the previous video to be written, which also raises any error that happened during its encoding
+        if self.future_video is not None:
+            self.future_video.result()
+        self.future_video = self.executor_video.submit(
+            self.write_video, f"{self.dir_videos}/video_t{t}.mp4", images
+        )
+
+    def close(self) -> None:
+        """Wait for the last video to be written and shut down the video encoding thread."""
+        if self.executor_video is None:
+            return
+        try:
+            if self.future_video is not None:
+                self.future_video.result()
+        finally:
+            self.future_video = None
+            self.executor_video.shutdown(wait=True)
+            self.executor_video = None
+
+    def write_video(self, filename: str, images: np.ndarray) -> None:
+        """Encode the frames of a video in a file. This is run in a background thread by render.
+
+        Args:
+            filename (str): the path of the video file
+            images (np.ndarray): the frames of the video, of shape (n_frames, H, W, 3), uint8
+        """
+        video_writer = VideoRecorder(filename=filename, fps=self.fps_video)
+        for image in images:
             video_writer.add(image)
         video_writer.close()
 
     # ================== Helper functions ==================
+    def get_channels_map(
+        self, state: StateEnvGridworld, names_channels: List[str]
+    ) -> jnp.ndarray:
+        """Assemble some channels of the map from the per-channel planes of the state, as a float map.
+
+        Args:
+            state (StateEnvGridworld): the state of the environment
+            names_channels (List[str]): the names of the channels to assemble, in order
+
+        Returns:
+            jnp.ndarray: the map of these channels, of shape (height, width, len(names_channels))
+        """
+        dict_name_channel_to_plane = {
+            "sun": state.map_sun,
+            "plants": state.map_plants,
+            "agents": state.map_agents,
+            "agent_ages": state.map_agent_ages,
+        }
+        for i in range(self.dim_appearance):
+            dict_name_channel_to_plane[f"appearance_{i}"] = state.map_appearances[..., i]
+        return jnp.stack(
+            [
+                dict_name_channel_to_plane[name_channel].astype(jnp.float32)
+                for name_channel in names_channels
+            ],
+            axis=-1,
+        )
+
+    def get_map(self, state: StateEnvGridworld) -> jnp.ndarray:
+        """Assemble the full map of the environment from the per-channel planes of the state.
+
+        Args:
+            state (StateEnvGridworld): the state of the environment
+
+        Returns:
+            jnp.ndarray: the map, of shape (height, width, n_channels_map), with the channels in the order of self.list_names_channels
+        """
+        return self.get_channels_map(state, self.list_names_channels)
+
     @partial(jax.jit, static_argnums=(0,))
     def get_RGB_map(self, images: jnp.ndarray) -> jnp.ndarray:
         """Get the RGB map by applying a color to each channel of a list of grey images and blend them together
@@ -678,7 +956,7 @@ class GridworldEnv(EcoEnvironment):
             np.ndarray: the blended image, of shape (height, width, 3), with the color applied to each channel,
                 with pixel values between 0 and 1
         """
-        # Initialize an empty array to store the blended image
+        # Get the background color
         assert (
             self.color_tag_background in DICT_COLOR_TAG_TO_RGB
         ), f"Unknown color tag: {self.color_tag_background}"
@@ -686,80 +964,52 @@ class GridworldEnv(EcoEnvironment):
             DICT_COLOR_TAG_TO_RGB[self.color_tag_background], dtype=jnp.float32
         )
 
-        blended_image = background * jnp.ones(
-            images.shape[:2] + (3,), dtype=jnp.float32
-        )
-
         # sum over all channels
-        print("images.shape", images.shape)
         channel_sum = (images[:, :, 1] + images[:, :, 2]).reshape(images.shape[:2] + (1,))
-        print("channel_sum.shape", channel_sum.shape)
-
-        # Iterate over each channel and apply the corresponding color.
-        # For each channel, we set the color at each tile to the channel colour
-        # with an intensity proportional to the number of entities (of that channel)
-        # in the tile, with nonzero intensities scaled to be between 0.3 and 1
-        for channel_idx, color_tag in self.dict_idx_channel_to_color_tag.items():
-            channel_name = self.list_names_channels[channel_idx]
-            if channel_name not in self.dict_name_channel_to_color_tag:
-                continue
-
-            # delta = jnp.array(
-            #     DICT_COLOR_TAG_TO_RGB[color_tag], dtype=jnp.float32
-            # ) - jnp.array(background, dtype=jnp.float32)
 
-            delta = jnp.array(DICT_COLOR_TAG_TO_RGB[color_tag], dtype=jnp.float32) - blended_image
-
-            img = images[:, :, channel_idx][:, :, None]
-            intensity = jnp.where(img > 0, 1, 0)
-            # intensity = jnp.where(intensity > 0, (intensity * 0.7) + 0.3, 0)
-            blended_image += delta * (intensity / jnp.maximum(channel_sum, 1))
-            # blended_image += delta * intensity
+        # Each colored channel is blended in turn over the image : at each tile, the channel colour is applied
+        # with a weight proportional to the presence of entities (of that channel) in the tile, i.e.
+        # blended_image <- blended_image + (color_c - blended_image) * weights_c for c = 0, 1, ..., C-1
+        weights = (images > 0) * self.are_channels_colored / jnp.maximum(channel_sum, 1)
+        # Unrolling this recursion, the color of channel c is weighted by weights_c * prod_{c' > c} (1 - weights_c')
+        # and the background by prod_{c'} (1 - weights_c'), which can be computed for all channels at once
+        keep = jnp.cumprod((1 - weights)[:, :, ::-1], axis=-1)[:, :, ::-1]
+        keep_after = jnp.concatenate([keep[:, :, 1:], jnp.ones_like(keep[:, :, :1])], axis=-1)
+        blended_image = background * keep[:, :, :1] + jnp.einsum(
+            "hwc,cd->hwd", weights * keep_after, self.colors_channels
+        )
 
         # Clip all rgb values to be between 0 and 1
         return jnp.clip(blended_image, 0, 1)
 
-    def upscale_image(self, image: jnp.ndarray) -> jnp.ndarray:
-        """Upscale an image to a maximum size while keeping the aspect ratio.
+    def upscale_image(self, image: np.ndarray) -> np.ndarray:
+        """Upscale (on the host) one or several images of the map to a maximum size while keeping the aspect ratio, with a nearest-neighbor upscaling.
 
         Args:
-            image (jnp.ndarray): the image to scale, of shape (H, W, C)
+            image (np.ndarray): the image(s) to scale, of shape (..., H, W, C)
 
         Returns:
-            jnp.ndarray: the scaled image, of shape (H', W', C), with H' <= self.height_max_video and W' <= self.width_max_video
+            np.ndarray: the scaled image(s), of shape (..., H', W', C), with H' <= self.height_max_video and W' <= self.width_max_video
         """
-        H, W, C = image.shape
-        upscale_factor = min(self.height_max_video / H, self.width_max_video / W)
-        upscale_factor = int(upscale_factor)
-        assert upscale_factor >= 1, "The upscale factor must be at least 1"
-        image_upscaled = jax.image.resize(
-            image,
-            shape=(H * upscale_factor, W * upscale_factor, C),
-            method="nearest",
-        )
-        return image_upscaled
+        k = self.upscale_factor_video
+        *dims_batch, H, W, C = image.shape
+        return np.broadcast_to(
+            image[..., :, None, :, None, :], (*dims_batch, H, k, W, k, C)
+        ).reshape(*dims_batch, H * k, W * k, C)
 
     def step_grow_plants(
         self, state: StateEnvGridworld, key_random: jnp.ndarray
     ) -> jnp.ndarray:
         """Modify the state of the environment by growing the plants."""
-        idx_sun = self.dict_name_channel_to_idx["sun"]
-        idx_plants = self.dict_name_channel_to_idx["plants"]
-        map_plants = state.map[:, :, self.dict_name_channel_to_idx["plants"]]
-        map_sun = state.map[:, :, idx_sun]
-        logits_plants = (
-            self.logit_p_base_plant_growth * (1 - map_plants)
-            + (1 - self.logit_p_base_plant_death) * map_plants
-        )
-        logits_plants = jnp.clip(logits_plants, -10, 10)
-        map_plants_probs = sigmoid(x=logits_plants)
-        key_random, subkey = jax.random.split(key_random)
+        map_plants_probs = jnp.where(
+            state.map_plants, self.p_plant_survival, self.p_plant_growth
+        )
         map_plants = jax.random.bernoulli(
-            key=subkey,
+            key=key_random,
             p=map_plants_probs,
-            shape=map_plants.shape,
+            shape=map_plants_probs.shape,
         )
-        return state.replace(map=state.map.at[:, :, idx_plants].set(map_plants))
+        return state.replace(map_plants=map_plants)
 
     def step_update_sun(
         self, state: StateEnvGridworld, key_random: jnp.ndarray
@@ -768,8 +1018,7 @@ class GridworldEnv(EcoEnvironment):
         The method of updating the sun is defined by the attribute self.method_sun.
         """
         # Update the latitude of the sun depending on the method
-        idx_sun = self.dict_name_channel_to_idx["sun"]
-        H, W, C = state.map.shape
+        H = self.height
         if self.method_sun == "none":
             return state
         elif self.method_sun == "fixed":
@@ -804,26 +1053,87 @@ class GridworldEnv(EcoEnvironment):
         shift = latitude_sun - state.latitude_sun
         return state.replace(
             latitude_sun=latitude_sun,
-            map=state.map.at[:, :, idx_sun].set(
-                jnp.roll(state.map[:, :, idx_sun], shift, axis=0)
-            ),
+            map_sun=jnp.roll(state.map_sun, shift, axis=0),
         )
 
     def get_facing_pos(self, position, orientation) -> jnp.ndarray:
-        angle = orientation * jnp.pi / 2
-        d_pos = jnp.array([jnp.cos(angle), -jnp.sin(angle)]).astype(jnp.int32)
-        return (position + d_pos) % jnp.array([self.height, self.width])
+        d_pos = jnp.asarray(self.d_positions_by_orientation)[orientation]
+        return ((position + d_pos) % jnp.array([self.height, self.width])).astype(
+            position.dtype
+        )
+
+    def get_tiles(self, positions: jnp.ndarray) -> jnp.ndarray:
+        """Get the flat indexes (x * width + y) of the tiles at the given positions.
+
+        Args:
+            positions (jnp.ndarray): the positions, of shape (n, 2)
+
+        Returns:
+            jnp.ndarray: the tile indexes, of shape (n,) in [0, height * width - 1]
+        """
+        positions = positions.astype(jnp.int32)
+        return positions[:, 0] * self.width + positions[:, 1]
+
+    def sum_per_tile(self, tiles: jnp.ndarray, values: jnp.ndarray) -> jnp.ndarray:
+        """Sum per-agent values over the tiles of the map, in a single scatter.
+
+        Args:
+            tiles (jnp.ndarray): the tile index of each agent, of shape (n,)
+            values (jnp.ndarray): the values of each agent, of shape (n, *dims_values)
+
+        Returns:
+            jnp.ndarray: the sum of the values on each tile, of shape (height, width, *dims_values)
+        """
+        values_tiles = jax.ops.segment_sum(values, tiles, num_segments=self.n_tiles)
+        return values_tiles.reshape((self.height, self.width) + values.shape[1:])
+
+    def select_one_per_tile(
+        self, tiles: jnp.ndarray, are_candidates: jnp.ndarray
+    ) -> jnp.ndarray:
+        """Select, among the candidate agents targeting each tile, the one with the lowest index, in a single scatter.
+
+        Args:
+            tiles (jnp.ndarray): the tile index targeted by each agent, of shape (n_agents_max,)
+            are_candidates (jnp.ndarray): whether each agent is a candidate for its tile, of shape (n_agents_max,)
+
+        Returns:
+            jnp.ndarray: whether each agent is the selected candidate of its tile, as a boolean array of shape (n_agents_max,)
+        """
+        indexes_candidates = jnp.where(
+            are_candidates, self.indexes_agents, self.n_agents_max
+        )
+        winners_tiles = jax.ops.segment_min(
+            indexes_candidates, tiles, num_segments=self.n_tiles
+        )
+        return are_candidates & (winners_tiles[tiles] == indexes_candidates)
+
+    def get_indexes_filled(self, mask: jnp.ndarray) -> jnp.ndarray:
+        """Get the indexes where a mask over the agents is True, in increasing order, filled with self.fill_value up to a constant (n_agents_max,) shape.
+        This is equivalent to jnp.where(mask, size=self.n_agents_max, fill_value=self.fill_value)[0], but computed with a linear prefix sum and a scatter instead of a sort.
+
+        Args:
+            mask (jnp.ndarray): a boolean mask over the agents, of shape (n_agents_max,)
+
+        Returns:
+            jnp.ndarray: the filled indexes [i1, i2, ..., i(n_true), f, f, ..., f], of shape (n_agents_max,)
+        """
+        ranks = jnp.cumsum(mask) - 1  # the position of each True index in the output
+        return (
+            jnp.full(self.n_agents_max, self.fill_value, dtype=jnp.int32)
+            .at[jnp.where(mask, ranks, self.n_agents_max)]
+            .set(self.indexes_agents, mode="drop")
+        )
 
     def compute_new_positions(
         self, key_random, curr_positions, facing_positions, is_moving, ages
     ):
-        is_infant = (ages < self.infancy_duration).astype(jnp.int32)
-        success_probs = jnp.where(
+        # infants only succeed in moving with probability self.infant_move_prob
+        is_infant = ages < self.infancy_duration
+        is_moving &= jnp.where(
             is_infant,
-            self.infant_move_prob,
-            1.0
+            jax.random.uniform(key_random, shape=is_infant.shape) < self.infant_move_prob,
+            True,
         )
-        is_moving &= jax.random.bernoulli(key_random, p=success_probs).astype(int)
 
         return jnp.where(
             is_moving[:, None],
@@ -832,10 +1142,8 @@ class GridworldEnv(EcoEnvironment):
         )
 
     def compute_new_orientations(self, curr_orientations, actions):
-        turning_left = (actions == self.action_to_idx["left"]).astype(jnp.int32)
-        turning_right = (actions == self.action_to_idx["right"]).astype(jnp.int32)
-        d_ori = turning_left + (3 * turning_right)
-        return (curr_orientations + d_ori) % 4
+        d_ori = jnp.asarray(self.d_orientation_by_action)[actions]
+        return ((curr_orientations + d_ori) % 4).astype(curr_orientations.dtype)
 
     def move_agents_allow_multiple_occupancy(
         self, key_random: jnp.ndarray, state: StateEnvGridworld, actions: jnp.ndarray
@@ -859,8 +1167,7 @@ class GridworldEnv(EcoEnvironment):
     def move_agents_enforce_single_occupancy(
         self, key_random: jnp.ndarray, state: StateEnvGridworld, actions: jnp.ndarray
     ):
-        H, W = state.map.shape[:2]
-        agent_map = state.map[:, :, self.dict_name_channel_to_idx["agents"]]
+        agent_map = state.map_agents
 
         # first we need to filter the set of agents that are
         # trying to move to ensure that no agent moves to an occupied cell, and at most
@@ -870,14 +1177,9 @@ class GridworldEnv(EcoEnvironment):
             state.agents.positions_agents, state.agents.orientation_agents
         )
         is_moving = is_attempting_move & (agent_map[facing_positions[:, 0], facing_positions[:, 1]] == 0)
-
-        facing_tiles = facing_positions[:, 0] * W + facing_positions[:, 1]
-        indices = jnp.lexsort((jnp.arange(self.n_agents_max), facing_tiles))
-        sorted_is_moving, sorted_facing = is_moving[indices], facing_tiles[indices]
-        same_as_prev = jnp.concatenate(
-            [jnp.array([False]), sorted_facing[1:] == sorted_facing[:-1]]
+        is_moving &= self.select_one_per_tile(
+            self.get_tiles(facing_positions), is_moving.astype(jnp.bool_)
         )
-        is_moving = jnp.where(same_as_prev, 0, sorted_is_moving)[jnp.argsort(indices)]
 
         # now we can compute the new positions
         new_positions = self.compute_new_positions(
@@ -902,12 +1204,9 @@ class GridworldEnv(EcoEnvironment):
         key_random: jnp.ndarray,
     ) -> Tuple[StateEnvGridworld, Dict[str, jnp.ndarray]]:
         """Modify the state of the environment by applying the actions of the agents."""
-        H, W, C = state.map.shape
-        idx_plants = self.dict_name_channel_to_idx["plants"]
-        idx_agents = self.dict_name_channel_to_idx["agents"]
-        map_plants = state.map[..., idx_plants]
-        map_agents = state.map[..., idx_agents]
+        map_plants = state.map_plants
         dict_measures: Dict[str, jnp.ndarray] = {}
+        key_move, key_eat, key_sun, key_plants = jax.random.split(key_random, 4)
 
         # ====== Compute the new positions and orientations of all the agents ======
         move_func = (
@@ -916,21 +1215,30 @@ class GridworldEnv(EcoEnvironment):
             else self.move_agents_enforce_single_occupancy
         )
         positions_agents_new, orientation_agents_new, facing_positions = move_func(
-            key_random, state, actions
+            key_move, state, actions
         )
 
         # FOR FEEDING EXPERIMENTS:
         # we want to determine the number of agents facing a tile containing another
         # agent, and then the number of those agents where the agent they're
         # facing is their offspring
-        def facing_offspring(idx):
-            same_pos = jnp.all(
-                state.agents.positions_agents == facing_positions[idx],
-                axis=-1
-            ).astype(int)
-            is_offspring = (state.agents.parent_agents == idx).astype(int)
-            return jnp.sum(same_pos), jnp.sum(same_pos * is_offspring)
-        facing_agents, facing_offsprings = jax.vmap(facing_offspring)(jnp.arange(self.n_agents_max))
+        are_existing_agents = state.agents.are_existing_agents
+        tiles_agents = self.get_tiles(state.agents.positions_agents)
+        facing_tiles = self.get_tiles(facing_positions)
+        map_agents = self.sum_per_tile(tiles_agents, are_existing_agents.astype(jnp.int32))
+        facing_agents = map_agents.reshape(-1)[facing_tiles] * are_existing_agents
+        # an agent is faced by its parent if it is on the tile its (existing) parent is facing
+        facing_tiles_parents = facing_tiles.at[state.agents.parent_agents].get(
+            mode="fill", fill_value=-1
+        )
+        are_existing_parents = are_existing_agents.at[state.agents.parent_agents].get(
+            mode="fill", fill_value=False
+        )
+        facing_offsprings = (
+            (tiles_agents == facing_tiles_parents)
+            & are_existing_agents
+            & are_existing_parents
+        )
         dict_measures["num_facing_agent"] = jnp.sum(facing_agents)
         dict_measures["num_facing_offspring"] = jnp.sum(facing_offsprings)
 
@@ -940,27 +1248,26 @@ class GridworldEnv(EcoEnvironment):
                 actions == self.action_to_idx["eat"]
             )
             is_infant = (state.agents.age_agents < self.infancy_duration).astype(jnp.int32)
-            success_probs = jnp.where(
+            # infants only succeed in eating with probability self.infant_eat_prob
+            are_agents_eating &= jnp.where(
                 is_infant,
-                self.infant_eat_prob,
-                1.0
+                jax.random.uniform(key_eat, shape=is_infant.shape) < self.infant_eat_prob,
+                True,
             )
-            are_agents_eating &= jax.random.bernoulli(key_random, p=success_probs).astype(int)
 
-            map_agents_try_eating = (
-                jnp.zeros_like(map_agents)
-                .at[positions_agents_new[:, 0], positions_agents_new[:, 1]]
-                .add(are_agents_eating)
+            tiles_agents_new = self.get_tiles(positions_agents_new)
+            map_agents_try_eating = self.sum_per_tile(
+                tiles_agents_new,
+                are_agents_eating.astype(jnp.float32),
             )  # map of the number of (existing) agents trying to eat at each cell
 
-            map_food_energy_bonus_available_per_agent = (
-                self.energy_food * map_plants / jnp.maximum(1, map_agents_try_eating)
-            )  # map of the energy available at each cell per (existing) agent trying to eat
-            food_energy_bonus = (
-                map_food_energy_bonus_available_per_agent[
-                    positions_agents_new[:, 0], positions_agents_new[:, 1]
-                ]
-                * are_agents_eating
+            # the energy of the plant on the tile of each agent trying to eat, shared between the agents trying to eat on that tile
+            food_energy_bonus = jnp.where(
+                are_agents_eating,
+                self.energy_food
+                * map_plants.reshape(-1)[tiles_agents_new]
+                / jnp.maximum(1, map_agents_try_eating.reshape(-1)[tiles_agents_new]),
+                0,
             )
             food_energy_bonus *= jnp.where(
                 is_infant,
@@ -978,8 +1285,7 @@ class GridworldEnv(EcoEnvironment):
                 ).sum() / jnp.maximum(1, are_agents_eating.sum())
 
             # Remove plants that have been eaten
-            map_plants -= map_agents_try_eating * map_plants
-            map_plants = jnp.clip(map_plants, 0, 1)
+            map_plants &= map_agents_try_eating == 0
 
         # ====== Handle any energy transfer actions ======
         if "transfer" in self.list_actions:
@@ -988,42 +1294,31 @@ class GridworldEnv(EcoEnvironment):
                 actions == self.action_to_idx["transfer"]
             )
 
-            def per_agent_helper_fn(i):
-                target_pos = self.get_facing_pos(
-                    state.agents.positions_agents[i], state.agents.orientation_agents[i]
-                )
-
-                are_receiving = (
-                    state.agents.are_existing_agents
-                    & (state.agents.positions_agents == target_pos).all(axis=1)
-                ).astype(jnp.int32)
-                is_transfer = are_agents_transferring[i] & jnp.any(are_receiving)
-
-                loss = is_transfer * self.energy_transfer_loss
-                gain = (
-                    is_transfer
-                    * self.energy_transfer_gain
-                    / jnp.maximum(1, jnp.sum(are_receiving))
-                )
-                delta_energy = jnp.zeros_like(state.agents.energy_agents).at[i].add(
-                    -loss
-                ) + (gain * are_receiving).astype(jnp.float32)
-
-                # determine if transfer is to offspring
-                # NOTE - assumes transfer is to only one agent
-                recv_agent = jnp.argmax(are_receiving)
-                recv_parent = state.agents.parent_agents[recv_agent]
-                is_to_offspring = (
-                    is_transfer
-                    & (recv_parent == i)
-                )
-
-                return (delta_energy, is_transfer, recv_agent, is_to_offspring)
+            # The receivers of a transfer are the existing agents on the tile the transferring agent is facing, the gain being shared between them
+            counts_receivers = map_agents.reshape(-1)[facing_tiles]
+            is_transfer = are_agents_transferring & (counts_receivers > 0)
+            gain_per_tile = self.sum_per_tile(
+                facing_tiles,
+                is_transfer
+                * self.energy_transfer_gain
+                / jnp.maximum(1, counts_receivers),
+            )
+            energy_agents_new += (
+                gain_per_tile.reshape(-1)[tiles_agents] * are_existing_agents
+                - is_transfer * self.energy_transfer_loss
+            )
 
-            transfer_delta_energy, is_transfer, recv_agents, to_offspring = jax.vmap(
-                per_agent_helper_fn, in_axes=0
-            )(jnp.arange(self.n_agents_max))
-            energy_agents_new += transfer_delta_energy.sum(axis=0)
+            # determine if transfer is to offspring
+            # NOTE - assumes transfer is to only one agent, the one with the lowest index on the facing tile
+            occupants_tiles = jax.ops.segment_min(
+                jnp.where(are_existing_agents, self.indexes_agents, self.n_agents_max),
+                tiles_agents,
+                num_segments=self.n_tiles,
+            )
+            recv_agents = jnp.where(counts_receivers > 0, occupants_tiles[facing_tiles], 0)
+            to_offspring = is_transfer & (
+                state.agents.parent_agents[recv_agents] == self.indexes_agents
+            )
 
             # log some metrics
             dict_measures["feeders"] = is_transfer
@@ -1052,10 +1347,12 @@ class GridworldEnv(EcoEnvironment):
             & state.agents.are_existing_agents
             & (state.agents.age_agents < self.age_max)
         )
+        are_just_dead_agents = (
+            state.agents.are_existing_agents & ~are_existing_agents_new
+        )
         if "life_expectancy" in self.names_measures:
-            just_died = state.agents.are_existing_agents & ~are_existing_agents_new
             le = jnp.where(
-                just_died,
+                are_just_dead_agents,
                 state.agents.age_agents,
                 jnp.nan
             )
@@ -1074,16 +1371,15 @@ class GridworldEnv(EcoEnvironment):
             appearance_agents=appearance_agents_new,
         )
         state = state.replace(
-            map=state.map.at[:, :, idx_plants].set(map_plants),
+            map_plants=map_plants,
+            n_agents=state.n_agents - jnp.sum(are_just_dead_agents, dtype=jnp.int32),
             agents=agents_new,
         )
 
         # Update the sun
-        key_random, subkey = jax.random.split(key_random)
-        state = self.step_update_sun(state=state, key_random=subkey)
+        state = self.step_update_sun(state=state, key_random=key_sun)
         # Grow plants
-        key_random, subkey = jax.random.split(key_random)
-        state = self.step_grow_plants(state=state, key_random=subkey)
+        state = self.step_grow_plants(state=state, key_random=key_plants)
 
         # Return the new state, as well as some metrics
         return state, dict_measures
@@ -1120,25 +1416,20 @@ class GridworldEnv(EcoEnvironment):
         #     ],
         #     axis=1,
         # )
-        # agent_map = state.map[:, :, self.dict_name_channel_to_idx["agents"]]
+        # agent_map = state.map_agents
         # agents_reprod &= agent_map[newborn_positions[:, 0], newborn_positions[:, 1]] == 0
 
         # Don't allow agents to reproduce into a tile that's already occupied
         facing_positions = jax.vmap(self.get_facing_pos, in_axes=(0, 0))(
             state.agents.positions_agents, state.agents.orientation_agents
         )
-        agent_map = state.map[:, :, self.dict_name_channel_to_idx["agents"]]
+        agent_map = state.map_agents
         agents_reprod &= agent_map[facing_positions[:, 0], facing_positions[:, 1]] == 0
 
         # Also don't allow multiple agents to reproduce into the same tile
-        H, W = state.map.shape[:2]
-        facing_tiles = facing_positions[:, 0] * W + facing_positions[:, 1]
-        indices = jnp.lexsort((jnp.arange(self.n_agents_max), facing_tiles))
-        sorted_reprod, sorted_facing = agents_reprod[indices], facing_tiles[indices]
-        same_as_prev = jnp.concatenate(
-            (jnp.array([False]), sorted_facing[1:] == sorted_facing[:-1])
+        agents_reprod &= self.select_one_per_tile(
+            self.get_tiles(facing_positions), agents_reprod.astype(jnp.bool_)
         )
-        agents_reprod = jnp.where(same_as_prev, 0, sorted_reprod)[jnp.argsort(indices)]
 
         if "reproduce" in self.list_actions:
             trying_reprod_action = actions == self.action_to_idx["reproduce"]
@@ -1150,7 +1441,7 @@ class GridworldEnv(EcoEnvironment):
 
         # Compute the number of newborns. If there are more agents trying to reproduce than there are ghost agents, only the first n_ghost_agents agents will be able to reproduce.
         n_agents_trying_reprod = jnp.sum(agents_reprod)
-        n_ghost_agents = jnp.sum(~are_existing_agents)
+        n_ghost_agents = self.n_agents_max - state.n_agents
         n_newborns = jnp.minimum(n_agents_trying_reprod, n_ghost_agents)
 
         # Compute which agents are actually reproducing
@@ -1167,93 +1458,111 @@ class GridworldEnv(EcoEnvironment):
         if "amount_children" in self.names_measures:
             dict_measures["amount_children"] = agents_reprod
 
-        # Get the indices of the ghost agents. To have constant (n_max_agents,) shape, we fill the remaining indices with the value self.n_agents_max (which will have no effect as an index of (n_agents_max,) array)
-        indices_ghost_agents_FILLED = jnp.where(
-            ~are_existing_agents,
-            size=self.n_agents_max,
-            fill_value=self.fill_value,
-        )[
-            0
-        ]  # placeholder_indices = [i1, i2, ..., i(n_ghost_agents), f, f, ..., f] of shape (n_max_agents,)
-
-        # Get the indices of the ghost agents that will become newborns and define the newborns
-        indices_newborn_agents_FILLED = jnp.where(
-            jnp.arange(self.n_agents_max) < n_newborns,
-            indices_ghost_agents_FILLED,
-            self.n_agents_max,
-        )  # placeholder_indices = [i1, i2, ..., i(n_newborns), f, f, ..., f] of shape (n_max_agents,), with n_newborns <= n_ghost_agents
-
-        are_newborns_agents = (
-            jnp.zeros(self.n_agents_max, dtype=jnp.bool_)
-            .at[indices_newborn_agents_FILLED]
-            .set(True)
-        )  # whether agent i is a newborn
-
-        # Get the indices of are_reproducing agents
-        indices_had_reproduced_FILLED = jnp.where(
-            agents_reprod,
-            size=self.n_agents_max,
-            fill_value=self.fill_value,
-        )[0]
+        def create_newborns(
+            agents: AgentGridworld,
+        ) -> Tuple[AgentGridworld, jnp.ndarray, jnp.ndarray]:
+            """Create the newborn agents of the reproducing agents, and return the updated agents, the newborns mask and the parents of each agent index"""
+            # Get the indices of the ghost agents. To have constant (n_max_agents,) shape, we fill the remaining indices with the value self.n_agents_max (which will have no effect as an index of (n_agents_max,) array)
+            indices_ghost_agents_FILLED = self.get_indexes_filled(
+                ~are_existing_agents
+            )  # placeholder_indices = [i1, i2, ..., i(n_ghost_agents), f, f, ..., f] of shape (n_max_agents,)
+
+            # Get the indices of the ghost agents that will become newborns and define the newborns
+            indices_newborn_agents_FILLED = jnp.where(
+                self.indexes_agents < n_newborns,
+                indices_ghost_agents_FILLED,
+                self.n_agents_max,
+            )  # placeholder_indices = [i1, i2, ..., i(n_newborns), f, f, ..., f] of shape (n_max_agents,), with n_newborns <= n_ghost_agents
+
+            are_newborns_agents = (
+                jnp.zeros(self.n_agents_max, dtype=jnp.bool_)
+                .at[indices_newborn_agents_FILLED]
+                .set(True)
+            )  # whether agent i is a newborn
+
+            # Get the indices of are_reproducing agents
+            indices_had_reproduced_FILLED = self.get_indexes_filled(
+                agents_reprod.astype(jnp.bool_)
+            )
 
-        agents_parents = jnp.full(
-            shape=(self.n_agents_max, 1), fill_value=self.fill_value, dtype=jnp.int32
-        )
-        agents_parents = agents_parents.at[indices_newborn_agents_FILLED].set(
-            indices_had_reproduced_FILLED[:, None]
-        )
+            agents_parents = jnp.full(
+                shape=(self.n_agents_max, 1), fill_value=self.fill_value, dtype=jnp.int32
+            )
+            agents_parents = agents_parents.at[indices_newborn_agents_FILLED].set(
+                indices_had_reproduced_FILLED[:, None]
+            )
 
-        # Update state.agents.parent_agents
-        parent_agents_new = state.agents.parent_agents.at[
-            indices_newborn_agents_FILLED
-        ].set(indices_had_reproduced_FILLED)
+            # Update agents.parent_agents
+            parent_agents_new = agents.parent_agents.at[
+                indices_newborn_agents_FILLED
+            ].set(indices_had_reproduced_FILLED)
 
-        # Decrease the energy of the agents that are reproducing
-        energy_agents_new = state.agents.energy_agents - (
-            agents_reprod * self.energy_cost_reprod
-        )
+            # Decrease the energy of the agents that are reproducing
+            energy_agents_new = agents.energy_agents - (
+                agents_reprod * self.energy_cost_reprod
+            )
 
-        # Initialize the newborn agents
-        are_existing_agents_new = are_existing_agents | are_newborns_agents
-        energy_agents_new = energy_agents_new.at[indices_newborn_agents_FILLED].set(
-            self.energy_initial
-        )
-        age_agents_new = state.agents.age_agents.at[indices_newborn_agents_FILLED].set(
-            0
-        )
+            # Initialize the newborn agents
+            are_existing_agents_new = are_existing_agents | are_newborns_agents
+            energy_agents_new = energy_agents_new.at[indices_newborn_agents_FILLED].set(
+                self.energy_initial
+            )
+            age_agents_new = agents.age_agents.at[indices_newborn_agents_FILLED].set(
+                0
+            )
 
-        # Initialize the newborn agents' positions
-        newborn_positions = facing_positions[indices_had_reproduced_FILLED]
-        positions_agents_new = state.agents.positions_agents.at[
-            indices_newborn_agents_FILLED
-        ].set(newborn_positions)
+            # Initialize the newborn agents' positions
+            newborn_positions = facing_positions[indices_had_reproduced_FILLED]
+            positions_agents_new = agents.positions_agents.at[
+                indices_newborn_agents_FILLED
+            ].set(newborn_positions)
 
-        # Initialize the newborn agents' appearances
-        key_random, subkey = jax.random.split(key_random)
-        noise_appearances = (
-            jax.random.normal(
-                key=subkey,
-                shape=(self.n_agents_max, self.config["dim_appearance"]),
+            # Initialize the newborn agents' appearances. The noise is a 0.001-scale perturbation, so it is sampled in bfloat16
+            noise_appearances = (
+                jax.random.normal(
+                    key=key_random,
+                    shape=(self.n_agents_max, self.dim_appearance),
+                    dtype=jnp.bfloat16,
+                )
+                * 0.001
+            ).astype(agents.appearance_agents.dtype)
+            appearance_agents_new = agents.appearance_agents.at[
+                indices_newborn_agents_FILLED
+            ].set(
+                agents.appearance_agents[indices_had_reproduced_FILLED]
+                + noise_appearances
             )
-            * 0.001
-        )
-        appearance_agents_new = state.agents.appearance_agents.at[
-            indices_newborn_agents_FILLED
-        ].set(
-            state.agents.appearance_agents[indices_had_reproduced_FILLED]
-            + noise_appearances
-        )
 
-        # Update the state
-        agents_new = state.agents.replace(
-            energy_agents=energy_agents_new,
-            are_existing_agents=are_existing_agents_new,
-            age_agents=age_agents_new,
-            positions_agents=positions_agents_new,
-            appearance_agents=appearance_agents_new,
-            parent_agents=parent_agents_new,
+            # Update the agents
+            agents_new = agents.replace(
+                energy_agents=energy_agents_new,
+                are_existing_agents=are_existing_agents_new,
+                age_agents=age_agents_new,
+                positions_agents=positions_agents_new,
+                appearance_agents=appearance_agents_new,
+                parent_agents=parent_agents_new,
+            )
+            return agents_new, are_newborns_agents, agents_parents
+
+        def skip_newborns(
+            agents: AgentGridworld,
+        ) -> Tuple[AgentGridworld, jnp.ndarray, jnp.ndarray]:
+            """Return the agents unchanged when no agent reproduces"""
+            return (
+                agents,
+                jnp.zeros(self.n_agents_max, dtype=jnp.bool_),
+                jnp.full(
+                    shape=(self.n_agents_max, 1),
+                    fill_value=self.fill_value,
+                    dtype=jnp.int32,
+                ),
+            )
+
+        # Only build the newborns when at least one agent reproduces
+        agents_new, are_newborns_agents, agents_parents = jax.lax.cond(
+            n_newborns > 0, create_newborns, skip_newborns, state.agents
         )
-        state = state.replace(agents=agents_new)
+        state = state.replace(agents=agents_new, n_agents=state.n_agents + n_newborns)
 
         return (
             state,
@@ -1277,30 +1586,37 @@ class GridworldEnv(EcoEnvironment):
             observation_agents (ObservationAgent): the observations of the agents
             dict_measures (Dict[str, jnp.ndarray]): a dictionary of the measures of the environment
         """
-        H, W, C_map = state.map.shape
+        H, W = self.height, self.width
 
         # get the visual field of the agents
-        map_vis_field = state.map[
-            :, :, self.list_indexes_channels_visual_field
-        ]
-
-        # add flag for whether agents are infants
-        poses = state.agents.positions_agents[::-1]
-        is_infant = state.agents.age_agents < self.infancy_duration
-        is_infant_map = jnp.zeros((H, W), dtype=jnp.int32).at[
-            poses[:, 0], poses[:, 1]
-        ].set(is_infant[::-1])
-        map_vis_field = map_vis_field.at[
-            :, :, self.dict_name_channel_to_idx["agent_ages"]
-        ].set(is_infant_map)
+        map_vis_field = self.get_channels_map(state, self.list_names_channels_visual_field)
+
+        # construct a map giving the index of the agent on each tile (the existing agent of lowest index if there are several), or self.fill_value if the tile is empty
+        agent_index_map = jax.ops.segment_min(
+            jnp.where(
+                state.agents.are_existing_agents,
+                self.indexes_agents,
+                self.fill_value,
+            ),
+            self.get_tiles(state.agents.positions_agents),
+            num_segments=self.n_tiles,
+        ).reshape((H, W))
+        agent_index_map = jnp.minimum(agent_index_map, self.fill_value)
+
+        # add flag for whether agents are infants, in place of the agent ages channel of the visual field
+        if self.idx_agent_ages_visual_field is not None:
+            is_infant = state.agents.age_agents < self.infancy_duration
+            is_infant_map = is_infant.at[agent_index_map].get(
+                mode="fill", fill_value=False
+            ).astype(jnp.int32)
+            map_vis_field = map_vis_field.at[
+                :, :, self.idx_agent_ages_visual_field
+            ].set(is_infant_map)
 
         # construct a map giving the index of each agent's parent (for agents not in the initial generation)
-        # note: we set in reverse order to avoid overriding any positions with ghost agents
-        agent_index_map = jnp.zeros((H, W), dtype=jnp.int32) + self.fill_value
-        agent_index_map = agent_index_map.at[poses[:, 0], poses[:, 1]].set(
-            jnp.arange(self.n_agents_max)[::-1]
+        agent_parent_map = state.agents.parent_agents.at[agent_index_map].get(
+            mode="fill", fill_value=self.fill_value
         )
-        agent_parent_map = state.agents.parent_agents[agent_index_map]
 
         def get_single_agent_visual_field(
             agent: AgentGridworld,
@@ -1314,41 +1630,28 @@ class GridworldEnv(EcoEnvironment):
             Returns:
                 jnp.ndarray: the visual field of the agent, of shape (2 * self.vision_radius + 1, 2 * self.vision_radius + 1, ?)
             """
-            # Get the visual field of the agent
-            visual_field_x = agent.positions_agents[0] + self.grid_indexes_vision_x
-            visual_field_y = agent.positions_agents[1] + self.grid_indexes_vision_y
+            # Get the visual field of the agent, already rotated according to its orientation
+            offsets_x, offsets_y = jnp.asarray(self.grid_indexes_vision_by_orientation)[
+                agent.orientation_agents
+            ]
+            visual_field_x = (agent.positions_agents[0] + offsets_x) % H
+            visual_field_y = (agent.positions_agents[1] + offsets_y) % W
             vis_field = map_vis_field[
-                visual_field_x % H,
-                visual_field_y % W,
+                visual_field_x,
+                visual_field_y,
             ]  # (2 * self.vision_radius + 1, 2 * self.vision_radius + 1, ...)
 
             parent_map_vis_field = agent_parent_map[
-                visual_field_x % H,
-                visual_field_y % W,
+                visual_field_x,
+                visual_field_y,
             ]
             is_offspring_vis_field = (parent_map_vis_field == agent_idx).astype(
                 jnp.int32
             )
-            vis_field = jnp.concatenate(
+            return jnp.concatenate(
                 [vis_field, is_offspring_vis_field[..., None]], axis=-1
             )
 
-            # Rotate the visual field according to the orientation of the agent
-            return jnp.select(
-                [
-                    agent.orientation_agents == 0,
-                    agent.orientation_agents == 1,
-                    agent.orientation_agents == 2,
-                    agent.orientation_agents == 3,
-                ],
-                [
-                    vis_field,
-                    jnp.rot90(vis_field, k=3, axes=(0, 1)), # if we turn left, the observation should be rotated right, eg 270 degrees
-                    jnp.rot90(vis_field, k=2, axes=(0, 1)),
-                    jnp.rot90(vis_field, k=1, axes=(0, 1)),
-                ],
-            )
-
         # Create the observation of the agents
         dict_observations: Dict[str, jnp.ndarray] = {}
         if "energy" in self.list_observations:
@@ -1362,7 +1665,7 @@ class GridworldEnv(EcoEnvironment):
         if "visual_field" in self.list_observations:
             dict_observations["visual_field"] = jax.vmap(
                 get_single_agent_visual_field, in_axes=(0, 0)
-            )(state.agents, jnp.arange(self.n_agents_max))
+            )(state.agents, self.indexes_agents)
 
         # observations = self.ObservationAgentGridworld(
         #     **{
@@ -1394,40 +1697,8 @@ class GridworldEnv(EcoEnvironment):
             Dict[str, jnp.ndarray]: a dictionary of the measures of the environment
         """
         dict_measures = {}
-        idx_plants = self.dict_name_channel_to_idx["plants"]
-        idx_agents = self.dict_name_channel_to_idx["agents"]
-        for name_measure in self.names_measures:
-            # Environment measures
-            if name_measure == "n_agents":
-                dict_measures["n_agents"] = jnp.sum(state.agents.are_existing_agents)
-            elif name_measure == "n_plants":
-                dict_measures["n_plants"] = jnp.sum(state.map[..., idx_plants])
-            # elif name_measure == "group_size":
-            #     group_sizes = compute_group_sizes(state.map[..., idx_agents])
-            #     dict_measures["average_group_size"] = group_sizes.mean()
-            #     dict_measures["max_group_size"] = group_sizes.max()
-            #     continue
-            # Immediate measures
-            elif name_measure.startswith("do_action_"):
-                str_action = name_measure[len("do_action_") :]
-                if str_action in self.list_actions:
-                    dict_measures[name_measure] = (
-                        actions == self.action_to_idx[str_action]
-                    ).astype(jnp.float32)
-            # State measures
-            elif name_measure == "energy":
-                dict_measures[name_measure] = state.agents.energy_agents
-            elif name_measure == "age":
-                dict_measures[name_measure] = state.agents.age_agents
-            elif name_measure == "x":
-                dict_measures[name_measure] = state.agents.positions_agents[:, 0]
-            elif name_measure == "y":
-                dict_measures[name_measure] = state.agents.positions_agents[:, 1]
-            elif name_measure == "appearance":
-                for i in range(self.config["dim_appearance"]):
-                    dict_measures[f"appearance_{i}"] = state.agents.appearance_agents[
-                        :, i
-                    ]
+        for handler in self.measure_handlers.values():
+            dict_measures.update(handler(state, actions))
             # # Behavior measures (requires state_species)
             # elif name_measure in self.config["metrics"]["measures"]["behavior"]:
             #     assert isinstance(
@@ -1446,6 +1717,44 @@ class GridworldEnv(EcoEnvironment):
         # Return the dictionary of measures
         return dict_measures
 
+    def compute_group_size_measures(
+        self, state: StateEnvGridworld
+    ) -> Dict[str, jnp.ndarray]:
+        """Get the average and maximum size of the groups of agents, a group being a set of agents on 8-connected tiles (sides or corners).
+        Both are 0 when there are no agents."""
+        group_sizes = compute_group_sizes_per_tile(state.map_agents)
+        return {
+            "average_group_size": jnp.sum(group_sizes)
+            / jnp.maximum(1, jnp.sum(group_sizes > 0)),
+            "max_group_size": jnp.max(group_sizes),
+        }
+
+    def compute_do_action_measures(
+        self,
+        state: StateEnvGridworld,
+        actions: jnp.ndarray,
+        dict_name_measure_to_idx_action: Dict[str, int],
+    ) -> Dict[str, jnp.ndarray]:
+        """Get the do_action_ measures, as columns of the one-hot encoding of the actions of the agents."""
+        actions_one_hot = jax.nn.one_hot(actions, self.n_actions, dtype=jnp.float32)
+        return {
+            name_measure: actions_one_hot[:, idx_action]
+            for name_measure, idx_action in dict_name_measure_to_idx_action.items()
+        }
+
+    def compute_position_measures(
+        self,
+        state: StateEnvGridworld,
+        actions: jnp.ndarray,
+        dict_name_measure_to_idx_coordinate: Dict[str, int],
+    ) -> Dict[str, jnp.ndarray]:
+        """Get the x and y measures, as columns of the positions of the agents."""
+        positions = state.agents.positions_agents
+        return {
+            name_measure: positions[:, idx_coordinate]
+            for name_measure, idx_coordinate in dict_name_measure_to_idx_coordinate.items()
+        }
+
     # def compute_metrics(
     #     self,
     #     state: StateEnvGridworld,
@@ -1521,31 +1830,42 @@ class GridworldEnv(EcoEnvironment):
 # ================== Helper functions ==================
 
 
-def compute_group_sizes(agent_map: jnp.ndarray) -> float:
-    H, W = agent_map.shape
-    done = set()
+def compute_group_sizes_per_tile(agent_map: jnp.ndarray) -> jnp.ndarray:
+    """Compute the sizes of the groups of agents on the map, jittably. A group is a set of occupied tiles connected by their sides or corners (without wrapping around the map), and its size is the number of agents on its tiles.
+    Each occupied tile starts with its own flat index as label, and each tile repeatedly takes the minimum label among itself and its 8 occupied neighbors (without wrapping around the map) until no label changes.
+    Each group then carries the flat index of its first tile in row-major order, and its size is stored at that index.
 
-    def dfs(i, j):
-        if (i, j) in done:
-            return 0
-        done.add((i, j))
+    Args:
+        agent_map (jnp.ndarray): the number of agents on each tile, of shape (H, W)
 
-        if i < 0 or j < 0 or i >= H or j >= W or agent_map[i, j] == 0:
-            return 0
+    Returns:
+        jnp.ndarray: the size of the group whose first tile is each tile, and 0 for the other tiles, of shape (H * W,)
+    """
+    H, W = agent_map.shape
+    n_tiles = H * W
+    is_occupied = agent_map > 0
+    labels_init = jnp.where(is_occupied, jnp.arange(n_tiles).reshape((H, W)), n_tiles)
+
+    def propagate_labels(carry: Tuple[jnp.ndarray, jnp.ndarray]):
+        labels, _ = carry
+        labels_padded = jnp.pad(labels, 1, constant_values=n_tiles)
+        labels_new = labels
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                labels_new = jnp.minimum(
+                    labels_new, labels_padded[1 + dx : 1 + dx + H, 1 + dy : 1 + dy + W]
+                )
+        # A label is the index of a tile of the same group, so taking the label of that tile (pointer jumping) speeds up the convergence
+        labels_new = labels_new.reshape(-1).at[labels_new].get(
+            mode="fill", fill_value=n_tiles
+        )
+        labels_new = jnp.where(is_occupied, labels_new, n_tiles)
+        return labels_new, jnp.any(labels_new != labels)
 
-        return (
-            int(agent_map[i, j])
-            + dfs(i + 1, j)
-            + dfs(i - 1, j)
-            + dfs(i, j + 1)
-            + dfs(i, j - 1)
-            + dfs(i - 1, j - 1)
-            + dfs(i - 1, j + 1)
-            + dfs(i + 1, j - 1)
-            + dfs(i + 1, j + 1)
-        )
-
-    groups = jnp.array(
-        [dfs(i, j) for i in range(H) for j in range(W) if agent_map[i, j] > 0]
+    labels, _ = jax.lax.while_loop(
+        lambda carry: carry[1], propagate_labels, (labels_init, jnp.array(True))
+    )
+    return jax.ops.segment_sum(
+        agent_map.reshape(-1), labels.reshape(-1), num_segments=n_tiles
     )
-    return groups[groups > 0]
+
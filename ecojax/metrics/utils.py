@@ -20,3 +20,22 @@ def get_dict_metrics_by_type(metrics: Dict[str, Any]):
         else:
             raise ValueError(f"Invalid metric type: {type(value)}")
     return metrics_scalar, metrics_histogram
+
+
+def explode_appearance(metrics: Dict[str, Any]) -> Dict[str, Any]:
+    """Split the (n_agents_max, dim_appearance) "appearance" measure into one "appearance_i" measure per dimension.
+    This is done at logging time only, so that the jitted step only handles a single appearance array.
+
+    Args:
+        metrics (Dict[str, Any]): the metrics, possibly containing an "appearance" matrix
+
+    Returns:
+        Dict[str, Any]: the metrics, with the "appearance" matrix replaced by its columns
+    """
+    if "appearance" not in metrics:
+        return metrics
+    metrics = metrics.copy()
+    appearances = np.asarray(metrics.pop("appearance"))
+    for i in range(appearances.shape[-1]):
+        metrics[f"appearance_{i}"] = appearances[..., i]
+    return metrics
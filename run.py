@@ -52,6 +52,14 @@ def main(config: DictConfig):
     print(OmegaConf.to_yaml(config))
     config = OmegaConf.to_container(config, resolve=True)
 
+    # Enable the persistent compilation cache, so that the compiled functions are reused across runs with the same shapes
+    if config.get("do_compile_cache", False):
+        jax.config.update(
+            "jax_compilation_cache_dir",
+            os.path.expanduser(config["compile_cache_dir"]),
+        )
+        jax.config.update("jax_persistent_cache_min_entry_size_bytes", 0)
+
     # Run in a snakeviz profile
     runner = Runner(config)
     runner.run()
@@ -73,7 +81,7 @@ class Runner:
         # Seed
         seed = try_get_seed(self.config)
         print(f"Using seed: {seed}")
-        np.random.seed(seed)
+        np.random.seed(seed)  # only used on the host, outside of the simulation loop (e.g. for the layout of the phylogenetic tree)
         key_random = random.PRNGKey(seed)
 
         # Run name
@@ -119,12 +127,12 @@ class Runner:
         agent_species.env = env # give the environment to the agent_species
 
         # ============== Simulation loop ===============
-        key_random, subkey = random.split(key_random)
+        # The key is only used by eco_loop, which splits it itself
         eco_loop(
             env=env,
             agent_species=agent_species,
             config=self.config,
-            key_random=subkey,
+            key_random=key_random,
         )
 
 
@@ -0,0 +1,146 @@
+from functools import partial
+
+from omegaconf import OmegaConf
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import random
+
+from ecojax.core.eco_loop import run_chunk
+from ecojax.environment.gridworld import GridworldEnv
+from ecojax.types import StateGlobal
+
+
+class TestRunChunk:
+
+    @classmethod
+    def setup_class(cls):
+        config = OmegaConf.load("configs/env/gridworld.yaml")
+        config = OmegaConf.to_container(config, resolve=True)
+        config.pop("defaults")
+        config_metrics = OmegaConf.load("configs/env/metrics/basic.yaml")
+        config_metrics = OmegaConf.to_container(config_metrics)
+        config_metrics["aggregators_lifespan"] = []
+        config_metrics["aggregators_population"] = []
+        config_metrics["config_video"]["do_video"] = False
+        config["metrics"] = config_metrics
+        config["height"] = 10
+        config["width"] = 10
+        cls.n_agents_max = 10
+        cls.env = GridworldEnv(
+            config=config,
+            n_agents_max=cls.n_agents_max,
+            n_agents_initial=5,
+        )
+
+    def test_chunked_run_equals_step_by_step_run(self):
+        global_state = self.get_initial_global_state()
+        global_state_chunked = jax.tree_util.tree_map(jnp.copy, global_state)
+
+        # Step by step
+        list_outputs = []
+        for _ in range(12):
+            global_state, outputs = self.step_env(global_state)
+            list_outputs.append(outputs)
+
+        # In chunks of at most 5 steps, the last chunk being cut short
+        run_chunk_jitted = jax.jit(
+            partial(
+                run_chunk,
+                self.step_env,
+                n_steps_per_chunk=5,
+                outputs_shape=jax.eval_shape(self.step_env, global_state_chunked)[1],
+            )
+        )
+        list_outputs_chunked = []
+        for n_steps in [5, 5, 2]:
+            global_state_chunked, outputs = run_chunk_jitted(
+                global_state_chunked, jnp.array(n_steps)
+            )
+            list_outputs_chunked += [
+                jax.tree_util.tree_map(lambda x: x[i], outputs) for i in range(n_steps)
+            ]
+
+        assert int(global_state_chunked.timestep_run) == 12
+        for leaf, leaf_chunked in zip(
+            jax.tree_util.tree_leaves((global_state, list_outputs)),
+            jax.tree_util.tree_leaves((global_state_chunked, list_outputs_chunked)),
+        ):
+            np.testing.assert_allclose(leaf, leaf_chunked, rtol=1e-6)
+
+    def test_steps_skipped(self):
+        # A counter in place of the environment, done when it reaches 3
+        def step(global_state: StateGlobal):
+            counter = global_state.state_env + 1
+            global_state = global_state.replace(
+                state_env=counter,
+                timestep_run=global_state.timestep_run + 1,
+                done=counter >= 3,
+            )
+            return global_state, counter
+
+        global_state = StateGlobal(
+            state_env=jnp.array(0),
+            state_species=None,
+            observations=None,
+            eco_information=None,
+            timestep_run=jnp.array(0),
+            done=jnp.array(False),
+            key_random=random.PRNGKey(0),
+        )
+        outputs_shape = jax.eval_shape(step, global_state)[1]
+
+        # The steps beyond n_steps are skipped
+        global_state_new, outputs = run_chunk(
+            step, global_state, jnp.array(2), 6, outputs_shape
+        )
+        assert int(global_state_new.timestep_run) == 2
+        assert not bool(global_state_new.done)
+        assert jnp.all(outputs == jnp.array([1, 2, 0, 0, 0, 0]))
+
+        # The steps after done are skipped
+        global_state_new, outputs = run_chunk(
+            step, global_state, jnp.array(5), 6, outputs_shape
+        )
+        assert int(global_state_new.timestep_run) == 3
+        assert bool(global_state_new.done)
+        assert jnp.all(outputs == jnp.array([1, 2, 3, 0, 0, 0]))
+
+    # ================ Helper methods ================
+
+    def get_initial_global_state(self) -> StateGlobal:
+        key_random = random.PRNGKey(1234)
+        key_random, subkey = random.split(key_random)
+        state_env, observations, eco_information, done, _ = self.env.reset(
+            key_random=subkey
+        )
+        return StateGlobal(
+            state_env=state_env,
+            state_species=None,
+            observations=observations,
+            eco_information=eco_information,
+            timestep_run=jnp.array(0),
+            done=done,
+            key_random=key_random,
+        )
+
+    def step_env(self, global_state: StateGlobal):
+        # Random actions in place of the agents
+        key_random, key_actions, key_env = random.split(global_state.key_random, 3)
+        actions = random.randint(
+            key_actions, (self.n_agents_max,), 0, self.env.n_actions
+        )
+        state_env, observations, eco_information, done, info = self.env.step(
+            state=global_state.state_env, actions=actions, key_random=key_env
+        )
+        global_state = StateGlobal(
+            state_env=state_env,
+            state_species=None,
+            observations=observations,
+            eco_information=eco_information,
+            timestep_run=global_state.timestep_run + 1,
+            done=done,
+            key_random=key_random,
+        )
+        return global_state, (eco_information, info)
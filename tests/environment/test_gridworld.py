@@ -1,3 +1,7 @@
+import copy
+import os
+import time
+
 from omegaconf import DictConfig, OmegaConf
 import pytest
 
@@ -5,24 +9,34 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 from jax import random
+from scipy import ndimage
 
+from ecojax.core.eco_info import EcoInformation
 from ecojax.environment.gridworld import (
-    ActionAgentGridworld,
-    ObservationAgentGridworld,
+    AgentGridworld,
     StateEnvGridworld,
     GridworldEnv,
+    compute_group_sizes_per_tile,
 )
-from ecojax.types import ObservationAgent, StateEnv
+from ecojax.utils import DICT_COLOR_TAG_TO_RGB
 
 
 class TestGridworldEnv:
 
     @classmethod
     def setup_class(cls):
-        config = OmegaConf.load("configs/env/small.yaml")
+        config = OmegaConf.load("configs/env/gridworld.yaml")
         config = OmegaConf.to_container(config, resolve=True)
+        config.pop("defaults")
+        config_metrics = OmegaConf.load("configs/env/metrics/basic.yaml")
+        config_metrics = OmegaConf.to_container(config_metrics)
+        config_metrics["aggregators_lifespan"] = []
+        config_metrics["aggregators_population"] = []
+        config_metrics["config_video"]["do_video"] = False
+        config["metrics"] = config_metrics
         config["height"] = 10
         config["width"] = 10
+        cls.config = config
         cls.n_agents_max = 10
         cls.n_agents_initial = 5
         cls.env = GridworldEnv(
@@ -44,33 +58,160 @@ class TestGridworldEnv:
         res = self.env.step(
             key_random=subkey,
             state=state,
-            actions=ActionAgentGridworld(direction=jnp.zeros((self.n_agents_max,))),
+            actions=jnp.zeros((self.n_agents_max,), dtype=jnp.int32),
         )
         self.check_env_step_return(res)
 
+    def test_rollout(self):
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=20)
+        state_step = self.copy(state)
+        for key_random, actions_step in zip(keys_random, actions):
+            state_step, *_ = self.env.step(
+                state=state_step, actions=actions_step, key_random=key_random
+            )
+        state_rollout, (observations, eco_information, done, info) = self.env.rollout(
+            state=state, keys_random=keys_random, actions=actions
+        )
+        assert int(state_rollout.timestep) == 20
+        assert eco_information.are_newborns_agents.shape == (20, self.n_agents_max)
+        for leaf_step, leaf_rollout in zip(
+            jax.tree_util.tree_leaves(state_step),
+            jax.tree_util.tree_leaves(state_rollout),
+        ):
+            np.testing.assert_allclose(leaf_step, leaf_rollout, rtol=1e-6)
+
+    def test_normalised_maps(self):
+        # Agents sharing tiles, and born during the rollout, so that the ages on a tile differ
+        env = self.get_env(
+            allow_multiple_agents_per_tile=True, energy_req_reprod=10, infancy_duration=0
+        )
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=30, env=env)
+        for key_random, actions_step in zip(keys_random, actions):
+            state, *_ = env.step(state=state, actions=actions_step, key_random=key_random)
+            agents = jax.device_get(state.agents)
+            for x in range(env.height):
+                for y in range(env.width):
+                    are_on_tile = agents.are_existing_agents & np.all(
+                        agents.positions_agents == np.array([x, y]), axis=-1
+                    )
+                    if not np.any(are_on_tile):
+                        assert state.map_agent_ages[x, y] == 0
+                        assert np.all(state.map_appearances[x, y] == 0)
+                        continue
+                    # The ages of the map are the ages before their increment at the end of the step
+                    np.testing.assert_allclose(
+                        state.map_agent_ages[x, y],
+                        np.mean(agents.age_agents[are_on_tile] - 1),
+                        rtol=1e-6,
+                    )
+                    np.testing.assert_allclose(
+                        state.map_appearances[x, y],
+                        np.mean(agents.appearance_agents[are_on_tile], axis=0),
+                        rtol=1e-6,
+                    )
+        assert int(jnp.max(state.map_agents)) > 1, "No tile is shared by several agents"
+
+    def test_get_RGB_map(self):
+        images = random.randint(
+            random.PRNGKey(1234), (10, 10, len(self.env.list_names_channels)), 0, 3
+        ).astype(jnp.float32)
+        # The channel by channel blending loop that get_RGB_map replaces
+        blended_image = jnp.array(
+            DICT_COLOR_TAG_TO_RGB[self.env.color_tag_background], dtype=jnp.float32
+        ) * jnp.ones((10, 10, 3), dtype=jnp.float32)
+        channel_sum = (images[:, :, 1] + images[:, :, 2])[:, :, None]
+        for channel_idx, color_tag in self.env.dict_idx_channel_to_color_tag.items():
+            if (
+                self.env.list_names_channels[channel_idx]
+                not in self.env.dict_name_channel_to_color_tag
+            ):
+                continue
+            delta = jnp.array(DICT_COLOR_TAG_TO_RGB[color_tag], dtype=jnp.float32) - blended_image
+            intensity = jnp.where(images[:, :, channel_idx][:, :, None] > 0, 1, 0)
+            blended_image += delta * (intensity / jnp.maximum(channel_sum, 1))
+        np.testing.assert_allclose(
+            self.env.get_RGB_map(images), jnp.clip(blended_image, 0, 1), atol=1e-6
+        )
+
+    def test_visual_field_rotation(self):
+        state, *_ = self.env.reset(key_random=random.PRNGKey(1234))
+        orientations = (jnp.arange(self.n_agents_max) % 4).astype(jnp.uint8)
+        observations, _ = self.env.get_observations_agents(
+            state.replace(agents=state.agents.replace(orientation_agents=orientations))
+        )
+        observations_unrotated, _ = self.env.get_observations_agents(
+            state.replace(
+                agents=state.agents.replace(orientation_agents=jnp.zeros_like(orientations))
+            )
+        )
+        # The unrotated visual field is the window of the map around the agent
+        map_vis_field = self.env.get_channels_map(state, ["plants", "agents"])
+        for idx_agent in range(self.n_agents_max):
+            x, y = state.agents.positions_agents[idx_agent]
+            window = map_vis_field[
+                (x + self.env.grid_indexes_vision_x) % self.env.height,
+                (y + self.env.grid_indexes_vision_y) % self.env.width,
+            ]
+            assert jnp.all(observations_unrotated["visual_field"][idx_agent, :, :, :2] == window)
+        # The rotation of the visual field by orientation that the precomputed offsets replace
+        def rotate(vis_field, orientation):
+            return jnp.select(
+                [orientation == 0, orientation == 1, orientation == 2, orientation == 3],
+                [
+                    vis_field,
+                    jnp.rot90(vis_field, k=3, axes=(0, 1)),
+                    jnp.rot90(vis_field, k=2, axes=(0, 1)),
+                    jnp.rot90(vis_field, k=1, axes=(0, 1)),
+                ],
+            )
+
+        assert jnp.all(
+            observations["visual_field"]
+            == jax.vmap(rotate)(observations_unrotated["visual_field"], orientations)
+        )
+
     def test_step_dynamics(self):
         key_random = random.PRNGKey(1234)
         key_random, subkey = random.split(key_random)
         state, *_ = self.env.reset(key_random=subkey)
-        state: StateEnvGridworld = state.replace(
-            positions_agents=jnp.array(
-                [
-                    [0, 0],
-                    [0, 0],
-                    [2, 2],
-                    [2, 2],
-                    [4, 4],
-                    [5, 5],
-                    [6, 6],
-                    [7, 7],
-                    [8, 8],
-                    [9, 9],
-                ]
+        # Agents 0 and 1 both move to (3, 3) : only the lowest index moves. Agent 2 moves to the tile of agent 3 : it does not move.
+        # Agent 4 turns left, agent 5 turns right, and agent 6 moves across the border. Agents 7 to 9 do not exist.
+        positions_agents = jnp.array(
+            [
+                [2, 3],
+                [4, 3],
+                [6, 6],
+                [6, 7],
+                [0, 0],
+                [9, 9],
+                [0, 5],
+                [1, 1],
+                [1, 2],
+                [1, 3],
+            ],
+            dtype=jnp.int16,
+        )
+        are_existing_agents = jnp.arange(self.n_agents_max) < 7
+        state = state.replace(
+            map_agents=self.env.sum_per_tile(
+                self.env.get_tiles(positions_agents),
+                are_existing_agents.astype(jnp.int32),
+            ),
+            n_agents=jnp.sum(are_existing_agents, dtype=jnp.int32),
+            agents=state.agents.replace(
+                positions_agents=positions_agents,
+                orientation_agents=jnp.array(
+                    [0, 2, 3, 0, 0, 0, 2, 0, 0, 0], dtype=jnp.uint8
+                ),
+                are_existing_agents=are_existing_agents,
             ),
-            orientation_agents=jnp.array([0, 0, 2, 3, 0, 1, 2, 3, 0, 1]),
         )
-        actions = ActionAgentGridworld(
-            direction=jnp.array([1, 1, 3, 0, 1, 2, 3, 0, 1, 2])
+        forward, left, right, idle = [
+            self.env.action_to_idx[name_action]
+            for name_action in ["forward", "left", "right", "idle"]
+        ]
+        actions = jnp.array(
+            [forward, forward, forward, idle, left, right, forward, idle, idle, idle]
         )
 
         state, *_ = self.env.step(
@@ -79,55 +220,266 @@ class TestGridworldEnv:
             actions=actions,
         )
 
+        positions_expected = jnp.array(
+            [[3, 3], [4, 3], [6, 6], [6, 7], [0, 0], [9, 9], [9, 5]]
+        )
         assert jnp.all(
-            state.positions_agents
-            == jnp.array(
-                [
-                    [0, 9],
-                    [0, 9],
-                    [2, 1],
-                    [2, 3],
-                    [4, 3],
-                    [5, 6],
-                    [6, 5],
-                    [7, 8],
-                    [8, 7],
-                    [9, 0],
-                ]
-            )
-        ), f"Positions are wrong: {state.positions_agents}"
+            state.agents.positions_agents[:7] == positions_expected
+        ), f"Positions are wrong: {state.agents.positions_agents}"
         assert jnp.all(
-            state.orientation_agents == jnp.array([1, 1, 1, 3, 1, 3, 1, 3, 1, 3])
-        ), f"Orientations are wrong: {state.orientation_agents}"
+            state.agents.orientation_agents[:7] == jnp.array([0, 2, 3, 0, 1, 3, 2])
+        ), f"Orientations are wrong: {state.agents.orientation_agents}"
+        map_agents_expected = (
+            jnp.zeros((10, 10), dtype=jnp.int32)
+            .at[positions_expected[:, 0], positions_expected[:, 1]]
+            .set(1)
+        )
         assert jnp.all(
-            state.map[:, :, self.env.dict_name_channel_to_idx["agents"]]
-            == jnp.array(
-                [
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 2],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 1, 0, 1, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 1, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                ]
+            state.map_agents == map_agents_expected
+        ), f"Map is wrong: {state.map_agents}"
+
+    def test_select_one_per_tile(self):
+        are_selected = self.env.select_one_per_tile(
+            tiles=jnp.array([3, 3, 5, 5, 7, 7, 7, 8, 9, 9]),
+            are_candidates=jnp.array([0, 1, 1, 1, 0, 0, 0, 1, 0, 1], dtype=bool),
+        )
+        assert jnp.all(
+            are_selected == jnp.array([0, 1, 1, 0, 0, 0, 0, 1, 0, 1], dtype=bool)
+        ), f"Selected agents are wrong: {are_selected}"
+
+    def test_facing_measures(self):
+        # Agents are born during the rollout, so that some agents face their offspring
+        env = self.get_env(energy_req_reprod=10, infancy_duration=0)
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=30, env=env)
+        n_facing_offspring = 0
+        for key_random, actions_step in zip(keys_random, actions):
+            agents = jax.device_get(state.agents)
+            state, _, _, _, info = env.step(
+                state=state, actions=actions_step, key_random=key_random
+            )
+            # Brute force count over all the pairs of existing agents
+            facing_positions = (
+                agents.positions_agents
+                + env.d_positions_by_orientation[agents.orientation_agents]
+            ) % np.array([env.height, env.width])
+            are_facing = np.all(
+                facing_positions[:, None, :] == agents.positions_agents[None, :, :],
+                axis=-1,
+            )  # are_facing[i, j] : whether agent i is facing agent j
+            are_facing &= agents.are_existing_agents[:, None]
+            are_facing &= agents.are_existing_agents[None, :]
+            are_parents = (
+                agents.parent_agents[None, :] == np.arange(self.n_agents_max)[:, None]
+            )  # are_parents[i, j] : whether agent i is the parent of agent j
+            assert int(info["metrics"]["num_facing_agent"]) == np.sum(are_facing)
+            assert int(info["metrics"]["num_facing_offspring"]) == np.sum(
+                are_facing & are_parents
+            )
+            n_facing_offspring += int(info["metrics"]["num_facing_offspring"])
+        assert n_facing_offspring > 0, "No agent faced its offspring"
+
+    def test_visual_field_infants(self):
+        state, *_ = self.env.reset(key_random=random.PRNGKey(1234))
+        # Agent 0 is an infant and agent 1 an adult
+        age_agents = state.agents.age_agents.at[0].set(0).at[1].set(self.env.infancy_duration)
+        observations, _ = self.env.get_observations_agents(
+            state.replace(agents=state.agents.replace(age_agents=age_agents))
+        )
+        idx_agent_ages = self.env.list_names_channels_visual_field.index("agent_ages")
+        v = self.env.vision_range_agent
+        # The tile of an agent is at the center of its visual field
+        visual_field_agent_ages = observations["visual_field"][:, :, :, idx_agent_ages]
+        assert visual_field_agent_ages[0, v, v] == 1
+        assert visual_field_agent_ages[1, v, v] == 0
+        # The flag is only set on the tiles holding an agent
+        idx_agents = self.env.list_names_channels_visual_field.index("agents")
+        are_tiles_occupied = observations["visual_field"][:, :, :, idx_agents] > 0
+        assert jnp.all(visual_field_agent_ages <= are_tiles_occupied)
+
+    def test_get_indexes_filled(self):
+        masks = [
+            jnp.zeros(self.n_agents_max, dtype=bool),
+            jnp.ones(self.n_agents_max, dtype=bool),
+        ] + [
+            random.bernoulli(key_random, 0.5, (self.n_agents_max,))
+            for key_random in random.split(random.PRNGKey(1234), 20)
+        ]
+        for mask in masks:
+            indexes_expected = jnp.where(
+                mask, size=self.n_agents_max, fill_value=self.env.fill_value
+            )[0]
+            indexes = self.env.get_indexes_filled(mask)
+            assert indexes.dtype == jnp.int32
+            assert jnp.all(indexes == indexes_expected), f"Indexes are wrong for {mask}: {indexes}"
+
+    def test_compute_group_sizes_per_tile(self):
+        rng = np.random.default_rng(1234)
+        compute_group_sizes_per_tile_jitted = jax.jit(compute_group_sizes_per_tile)
+        for H, W in [(1, 1), (1, 7), (5, 5), (8, 11), (10, 10)] * 60:
+            density = rng.uniform(0, 1)
+            agent_map = rng.integers(1, 4, size=(H, W)) * (rng.uniform(size=(H, W)) < density)
+            # Brute-force 8-connected labelling, the size of each group being stored at its first tile in row-major order
+            labels, n_groups = ndimage.label(agent_map > 0, structure=np.ones((3, 3)))
+            group_sizes_expected = np.zeros(H * W, dtype=agent_map.dtype)
+            for label in range(1, n_groups + 1):
+                idx_first_tile = np.flatnonzero(labels == label)[0]
+                group_sizes_expected[idx_first_tile] = ndimage.sum_labels(
+                    agent_map, labels, index=label
+                )
+            group_sizes = compute_group_sizes_per_tile_jitted(jnp.asarray(agent_map))
+            assert np.all(
+                np.asarray(group_sizes) == group_sizes_expected
+            ), f"Group sizes are wrong for the map {agent_map}"
+
+    def test_skip_measures(self):
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=1)
+        res_computed = self.env.step(
+            state=self.copy(state),
+            actions=actions[0],
+            key_random=keys_random[0],
+            do_compute_measures=jnp.array(True),
+        )
+        # The shapes and dtypes of the measures of compute_measures, the state being donated to the step below
+        shape_measures = jax.eval_shape(
+            lambda: self.env.compute_measures(
+                state=state,
+                actions=actions[0],
+                state_new=res_computed[0],
+                key_random=keys_random[0],
+                state_species=None,
             )
-        ), f"Map is wrong: {state.map[:, :, self.env.dict_name_channel_to_idx['agents']]}"
+        )
+        res_skipped = self.env.step(
+            state=state,
+            actions=actions[0],
+            key_random=keys_random[0],
+            do_compute_measures=jnp.array(False),
+        )
+        # Everything but the measures of compute_measures is unchanged
+        for leaf_computed, leaf_skipped in zip(
+            jax.tree_util.tree_leaves(res_computed[:4]),
+            jax.tree_util.tree_leaves(res_skipped[:4]),
+        ):
+            np.testing.assert_array_equal(leaf_computed, leaf_skipped)
+        metrics_computed, metrics_skipped = (
+            res_computed[4]["metrics"],
+            res_skipped[4]["metrics"],
+        )
+        assert metrics_computed.keys() == metrics_skipped.keys()
+        assert "n_agents" in shape_measures
+        are_existing_agents = res_skipped[0].agents.are_existing_agents
+        for name_measure, measure_skipped in metrics_skipped.items():
+            if name_measure not in shape_measures:
+                np.testing.assert_array_equal(
+                    metrics_computed[name_measure], measure_skipped
+                )
+                continue
+            # The per-agent measures are then set to NaN for the non existing agents
+            if name_measure not in self.env.names_measures_environmental:
+                measure_skipped = measure_skipped[are_existing_agents]
+            if jnp.issubdtype(shape_measures[name_measure].dtype, jnp.floating):
+                assert jnp.all(jnp.isnan(measure_skipped)), name_measure
+            else:
+                assert jnp.all(measure_skipped == 0), name_measure
+
+    def test_counters(self):
+        # Agents born during the rollout, so that the counters are also tested on births
+        env = self.get_env(energy_req_reprod=10, infancy_duration=0)
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=30, env=env)
+        n_newborns = 0
+        for key_random, actions_step in zip(keys_random, actions):
+            n_agents_map = int(jnp.sum(state.map_agents))
+            n_plants_map = int(jnp.sum(state.map_plants))
+            state, _, eco_information, _, info = env.step(
+                state=state, actions=actions_step, key_random=key_random
+            )
+            n_newborns += int(jnp.sum(eco_information.are_newborns_agents))
+            assert int(state.n_agents) == int(jnp.sum(state.agents.are_existing_agents))
+            assert int(state.n_agents) == int(jnp.sum(state.map_agents))
+            # The environmental measures are computed on the state before the step
+            assert int(info["metrics"]["n_agents"]) == n_agents_map
+            assert int(info["metrics"]["n_plants"]) == n_plants_map
+            # Single occupancy of the tiles
+            assert int(jnp.max(state.map_agents)) <= 1
+        assert n_newborns > 0, "No agent was born, the counters are not tested on births"
+
+    @pytest.mark.parametrize("n_steps", [3, 5, 12])
+    def test_render(self, tmp_path, n_steps):
+        n_steps_per_video = 5
+        config_metrics = copy.deepcopy(self.config["metrics"])
+        config_metrics["config_video"].update(
+            do_video=True, n_steps_per_video=n_steps_per_video, dir_videos=str(tmp_path)
+        )
+        env = self.get_env(metrics=config_metrics)
+        # Record the videos written, the encoding being slow enough for close to have to wait for it
+        videos_written = {}
+        write_video = env.write_video
+
+        def write_video_slowly(filename, images):
+            time.sleep(0.5)
+            write_video(filename, images)
+            videos_written[filename] = images
+
+        env.write_video = write_video_slowly
+
+        state, keys_random, actions = self.get_random_rollout_inputs(n_steps=n_steps, env=env)
+        frames = []
+        for key_random, actions_step in zip(keys_random, actions):
+            state, *_ = env.step(state=state, actions=actions_step, key_random=key_random)
+            rgb_map = env.get_RGB_map(images=env.get_map(state))
+            frames.append(np.asarray((rgb_map * 255).astype(jnp.uint8)))
+        env.render(state)
+        env.close()
+        assert env.executor_video is None
+
+        filename = f"{tmp_path}/video_t{n_steps}.mp4"
+        if n_steps < n_steps_per_video:
+            assert videos_written == {}, "No video should be written before the buffer is full"
+            return
+        assert list(videos_written) == [filename]
+        images = videos_written[filename]
+        assert images.dtype == np.uint8
+        # The frames are the last n_steps_per_video ones, in chronological order
+        images_expected = env.upscale_image(np.stack(frames[-n_steps_per_video:]))
+        assert np.array_equal(images, images_expected)
+        assert os.path.getsize(filename) > 0
 
     # ================ Helper methods ================
 
+    def copy(self, state: StateEnvGridworld) -> StateEnvGridworld:
+        # The buffers of the state given to step are donated
+        return jax.tree_util.tree_map(jnp.copy, state)
+
+    def get_env(self, **config_overrides) -> GridworldEnv:
+        return GridworldEnv(
+            config={**self.config, **config_overrides},
+            n_agents_max=self.n_agents_max,
+            n_agents_initial=self.n_agents_initial,
+        )
+
+    def get_random_rollout_inputs(self, n_steps: int, env: GridworldEnv = None):
+        env = self.env if env is None else env
+        key_random = random.PRNGKey(1234)
+        key_reset, key_steps, key_actions = random.split(key_random, 3)
+        state, *_ = env.reset(key_random=key_reset)
+        keys_random = random.split(key_steps, n_steps)
+        actions = random.randint(
+            key_actions, (n_steps, self.n_agents_max), 0, env.n_actions
+        )
+        return state, keys_random, actions
+
     def check_env_step_return(self, res):
-        assert len(res) == 5, "The result should have 4 elements"
+        assert len(res) == 5, "The result should have 5 elements"
         (
             env_state,
             agent_observations,
-            dict_reproduction,
+            eco_information,
             done_env,
             info_env,
         ) = res
         assert isinstance(env_state, StateEnvGridworld)
-        assert isinstance(agent_observations, ObservationAgentGridworld)
-        assert isinstance(dict_reproduction, dict)
+        assert isinstance(env_state.agents, AgentGridworld)
+        assert isinstance(agent_observations, dict)
+        assert agent_observations["visual_field"].shape[0] == self.n_agents_max
+        assert isinstance(eco_information, EcoInformation)
+        assert isinstance(info_env, dict)